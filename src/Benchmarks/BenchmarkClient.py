@@ -0,0 +1,142 @@
+import logging
+import socket
+import struct
+from os import urandom
+
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import x25519
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+
+from Dependencies.Constants import separator, byte_data_flag, string_data_flag, end_flag, init_flag, resume_flag, \
+    encryption_separator, busy_flag
+
+bulk_upload_entry_header = struct.Struct(">HHQ")
+
+
+def pack_bulk_upload_frames(entries, frame_size):
+    frame = bytearray()
+    for path, name, contents in entries:
+        path, name = path.encode(), name.encode()
+        if frame and len(frame) + bulk_upload_entry_header.size + len(path) + len(name) + len(contents) > frame_size:
+            yield bytes(frame)
+            frame = bytearray()
+        frame += bulk_upload_entry_header.pack(len(path), len(name), len(contents)) + path + name + contents
+    if frame:
+        yield bytes(frame)
+
+
+class ServerBusyError(ConnectionError):
+    def __init__(self, retry_after):
+        super().__init__(f"Server busy, retry after {retry_after}s")
+        self.retry_after = retry_after
+
+
+class BenchmarkClient:
+    """
+    Scripted client speaking the same wire protocol as the real CryptDrive client.
+    Every request opens a new connection, like the real client does. The first request performs the
+    init_flag X25519 handshake; later requests resume the session with resume_flag and the encryption token.
+    """
+    def __init__(self, server_addr, resume_sessions=True, raw_keys=False, timeout=30):
+        self.server_addr = server_addr
+        self.resume_sessions = resume_sessions
+        self.raw_keys = raw_keys
+        self.timeout = timeout
+        self.aesgcm = None
+        self.encryption_token = b""
+        self.login_token = ""
+        self.handshakes = 0
+
+    def request(self, verb, *data, file_contents=None, file_frames=None):
+        """
+        Sends one request and returns (status_parts, response_data).
+        status_parts is the response message split on the separator, e.g. ["SUCCESS", token, "SENDING_DATA"].
+        file_frames are streamed back to back after READY_FOR_DATA, followed by the empty frame that ends the stream.
+        """
+        message = separator.join([verb, self.login_token, *data]).encode()
+        with socket.create_connection(self.server_addr, timeout=self.timeout) as connection:
+            if self.aesgcm is None or not self.resume_sessions:
+                self._handshake(connection)
+            self._send_encrypted(connection, message)
+            status_parts, response_data = self._receive_response(connection)
+            if status_parts is None:
+                # The server rejected our session token and expects a fresh handshake on this connection.
+                self._handshake(connection)
+                self._send_encrypted(connection, message)
+                status_parts, response_data = self._receive_response(connection)
+
+            if file_contents is not None and status_parts[-1] == "READY_FOR_DATA":
+                self._send_encrypted(connection, file_contents)
+                status_parts, response_data = self._receive_response(connection)
+            elif file_frames is not None and status_parts[-1] == "READY_FOR_DATA":
+                for frame in file_frames:
+                    self._send_encrypted(connection, frame)
+                self._send_encrypted(connection, b"")
+                status_parts, response_data = self._receive_response(connection)
+
+        if status_parts[0] == "SUCCESS" and verb in ("SIGN_UP", "LOG_IN"):
+            self.login_token = status_parts[1]
+        return status_parts, response_data
+
+    def bulk_upload(self, entries, frame_size=1024 * 1024):
+        """Uploads (path, name, contents) entries with BULK_UPLOAD, packed into frames of about frame_size bytes."""
+        return self.request("BULK_UPLOAD", file_frames=pack_bulk_upload_frames(entries, frame_size))
+
+    def _handshake(self, connection):
+        private_key = x25519.X25519PrivateKey.generate()
+        if self.raw_keys:
+            public_key_bytes = private_key.public_key().public_bytes(serialization.Encoding.Raw, serialization.PublicFormat.Raw)
+        else:
+            public_key_bytes = private_key.public_key().public_bytes(serialization.Encoding.PEM,
+                                                                     serialization.PublicFormat.SubjectPublicKeyInfo)
+        connection.sendall(init_flag + encryption_separator + encryption_separator + encryption_separator + public_key_bytes + end_flag)
+
+        flag, self.encryption_token, _, server_public_key_bytes = self._receive_frame(connection)
+        if self.raw_keys:
+            server_public_key = x25519.X25519PublicKey.from_public_bytes(server_public_key_bytes)
+        else:
+            server_public_key = serialization.load_pem_public_key(server_public_key_bytes)
+        key = HKDF(algorithm=hashes.SHA256(), length=32, salt=None, info=b"encryption key").derive(private_key.exchange(server_public_key))
+        self.aesgcm = AESGCM(key)
+        self.handshakes += 1
+
+    def _send_encrypted(self, connection, message: bytes):
+        nonce = urandom(12)
+        connection.sendall(resume_flag + encryption_separator + self.encryption_token + encryption_separator + nonce
+                           + encryption_separator + self.aesgcm.encrypt(nonce, message, None) + end_flag)
+
+    def _receive_response(self, connection):
+        flag, token, nonce, encrypted_message = self._receive_frame(connection)
+        if flag == init_flag:
+            return None, None
+        self.encryption_token = token
+        response = self.aesgcm.decrypt(nonce, encrypted_message, None)
+
+        response_data = None
+        for data_flag in (byte_data_flag, string_data_flag):
+            if data_flag in response:
+                response, response_data = response.split(data_flag, 1)
+                break
+        return response.decode().split(separator), response_data
+
+    def _receive_frame(self, connection):
+        received_data = bytearray()
+        while not received_data.endswith(end_flag):
+            data_chunk = connection.recv(65536)
+            if not data_chunk:
+                raise ConnectionResetError("Server closed the connection mid-response")
+            received_data += data_chunk
+        frame = bytes(received_data[:-len(end_flag)]).split(encryption_separator, 3)
+        if frame[0] == busy_flag:
+            raise ServerBusyError(float(frame[3]))
+        return frame
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.DEBUG)
+
+    from Dependencies.Constants import host_addr
+    client = BenchmarkClient(("127.0.0.1", host_addr[1]))
+    print(client.request("SIGN_UP", urandom(8).hex(), "123123123123"))
+    print(client.request("GET_ITEMS_LIST", "/"))
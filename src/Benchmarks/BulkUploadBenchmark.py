@@ -0,0 +1,66 @@
+import argparse
+import json
+import os
+import tempfile
+import time
+import uuid
+
+from Benchmarks.BenchmarkClient import BenchmarkClient
+from Benchmarks.ServerBenchmark import ServerProcess, get_free_port, wait_for_server, BENCHMARK_PASSWORD_HASH
+
+
+def upload_one_by_one(client, entries):
+    for path, name, contents in entries:
+        status_parts, _ = client.request("CREATE_FILE", path, name, file_contents=contents)
+        if status_parts[-1] != "FILE_CREATED":
+            raise RuntimeError(f"CREATE_FILE {path}/{name} failed: {status_parts}")
+
+
+def upload_in_bulk(client, entries, frame_size):
+    status_parts, response_data = client.bulk_upload(entries, frame_size)
+    if status_parts[-1] != "FILES_CREATED":
+        raise RuntimeError(f"BULK_UPLOAD failed: {status_parts}")
+    failed = [result for result in json.loads(response_data) if result["status"] != "FILE_CREATED"]
+    if failed:
+        raise RuntimeError(f"BULK_UPLOAD failed for {len(failed)} files, e.g. {failed[0]}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Uploads a folder of small files with CREATE_FILE per file and with one BULK_UPLOAD.")
+    parser.add_argument("--files", type=int, default=2000)
+    parser.add_argument("--file-size", type=int, default=4096)
+    parser.add_argument("--dirs", type=int, default=20, help="files are spread over this many subdirectories")
+    parser.add_argument("--frame-size", type=int, default=1024 * 1024, help="bytes of entries per BULK_UPLOAD frame")
+    parser.add_argument("--port", type=int, default=0, help="server port (default: a free port)")
+    parser.add_argument("--server-log-level", default="WARNING")
+    args = parser.parse_args()
+
+    port = args.port or get_free_port()
+    server_addr = ("127.0.0.1", port)
+    with tempfile.TemporaryDirectory(prefix="cryptdrive-bulk-bench-") as storage_path:
+        server_process = ServerProcess(port, storage_path, args.server_log_level)
+        server_process.start()
+        try:
+            wait_for_server(server_addr, server_process)
+            print(f"{'method':<14}{'files':>8}{'seconds':>10}{'files/s':>10}{'MiB/s':>10}")
+            for name, upload in (("CREATE_FILE", upload_one_by_one),
+                                 ("BULK_UPLOAD", lambda client, entries: upload_in_bulk(client, entries, args.frame_size))):
+                client = BenchmarkClient(server_addr)
+                client.request("SIGN_UP", f"bulk-{uuid.uuid4().hex[:12]}", BENCHMARK_PASSWORD_HASH)
+                if name == "CREATE_FILE":
+                    # CREATE_FILE does not create parent directories
+                    for number in range(args.dirs):
+                        client.request("CREATE_DIR", "/", f"dir_{number}")
+                entries = [(f"/dir_{number % args.dirs}", f"file_{number}.bin", os.urandom(args.file_size))
+                           for number in range(args.files)]
+                start = time.perf_counter()
+                upload(client, entries)
+                seconds = time.perf_counter() - start
+                print(f"{name:<14}{args.files:>8}{seconds:>10.2f}{args.files / seconds:>10.1f}"
+                      f"{args.files * args.file_size / seconds / 2**20:>10.1f}")
+        finally:
+            server_process.stop()
+
+
+if __name__ == "__main__":
+    main()
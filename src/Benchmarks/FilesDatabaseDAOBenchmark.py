@@ -0,0 +1,97 @@
+import argparse
+import os
+import tempfile
+import time
+import uuid
+
+
+def query_builder_lookups(FilesDB):
+    # FilesDatabaseDAO's lookups before the raw-row path, for comparison
+    def does_file_exist(file_owner_id, user_file_path, user_file_name):
+        return FilesDB.select().where(
+            FilesDB.file_owner_id == file_owner_id,
+            FilesDB.user_file_path == user_file_path,
+            FilesDB.user_file_name == user_file_name,
+            FilesDB.is_directory == False
+        ).exists()
+
+    def get_file_uuid(file_owner_id, user_file_path, user_file_name):
+        return FilesDB.select().where(
+            FilesDB.file_owner_id == file_owner_id,
+            FilesDB.user_file_path == user_file_path,
+            FilesDB.user_file_name == user_file_name,
+            FilesDB.is_directory == False
+        ).get().file_uuid
+
+    def does_dir_exist(file_owner_id, dir_path, dir_name):
+        return FilesDB.select().where(
+            FilesDB.file_owner_id == file_owner_id,
+            FilesDB.user_file_path == dir_path,
+            FilesDB.user_file_name == dir_name,
+            FilesDB.is_directory == True
+        ).exists()
+
+    def get_all_files_in_path(file_owner_id, path):
+        return list(FilesDB.select().where(
+            FilesDB.file_owner_id == file_owner_id,
+            FilesDB.user_file_path == path,
+            FilesDB.is_directory == False
+        ))
+
+    def get_item_count_for_dir(file_owner_id, path):
+        return len(list(FilesDB.select().where(
+            FilesDB.file_owner_id == file_owner_id,
+            FilesDB.user_file_path == path,
+        )))
+
+    return {
+        "does_file_exist": does_file_exist,
+        "get_file_uuid": get_file_uuid,
+        "does_dir_exist": does_dir_exist,
+        "get_all_files_in_path": get_all_files_in_path,
+        "get_item_count_for_dir": get_item_count_for_dir,
+    }
+
+
+def measure(function, args, calls):
+    function(*args)  # warm up the statement cache
+    start = time.perf_counter()
+    for _ in range(calls):
+        function(*args)
+    return (time.perf_counter() - start) / calls
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Per-call cost of the hot FilesDatabaseDAO lookups, query builder vs raw rows.")
+    parser.add_argument("--calls", type=int, default=20000)
+    parser.add_argument("--files-per-dir", type=int, default=50, help="size of the listing the listing queries return")
+    args = parser.parse_args()
+
+    # Constants reads the storage path at import, so point it at a scratch directory first
+    os.environ.setdefault("CRYPTDRIVE_STORAGE_PATH", tempfile.mkdtemp(prefix="cryptdrive-dao-benchmark-"))
+    from DAOs.FilesDatabaseDAO import FilesDatabaseDAO, FilesDB
+
+    dao = FilesDatabaseDAO()
+    owner_id = 1
+    dao.create_dir(owner_id, "/", "docs")
+    for number in range(args.files_per_dir):
+        dao.create_file(owner_id, "/docs", uuid.uuid4().hex, f"file_{number}.txt", number)
+
+    cases = {
+        "does_file_exist": (owner_id, "/docs", "file_7.txt"),
+        "get_file_uuid": (owner_id, "/docs", "file_7.txt"),
+        "does_dir_exist": (owner_id, "/", "docs"),
+        "get_all_files_in_path": (owner_id, "/docs"),
+        "get_item_count_for_dir": (owner_id, "/docs"),
+    }
+    before = query_builder_lookups(FilesDB)
+    print(f"{'lookup':<24}{'query builder us':>18}{'raw rows us':>14}{'speedup':>10}")
+    for name, call_args in cases.items():
+        listing_calls = args.calls // 10 if "path" in name or "count" in name else args.calls
+        before_seconds = measure(before[name], call_args, listing_calls)
+        after_seconds = measure(getattr(dao, name), call_args, listing_calls)
+        print(f"{name:<24}{before_seconds * 1e6:>18.1f}{after_seconds * 1e6:>14.1f}{before_seconds / after_seconds:>9.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+import argparse
+import socket
+import threading
+import time
+import tracemalloc
+from os import urandom
+
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+from Dependencies.Constants import byte_data_flag, encryption_separator, end_flag, resume_flag
+from Services.ConnectionLifecycleManager import ConnectionLifecycle
+from Services.EphemeralKeyPool import EphemeralKeyPool
+from Services.SecureCommunicationManager import SecureCommunicationManager
+from Services.TokenService import TokenService
+
+STATUS = b"SUCCESS|||token|||SENDING_DATA"
+
+
+def drain(connection, total_bytes):
+    remaining = total_bytes
+    while remaining > 0:
+        remaining -= len(connection.recv(1 << 20))
+
+
+def concatenating_send(connection, aesgcm, token, file_contents):
+    # The send path before scatter-gather: join the message, encrypt, join the frame, sendall
+    message = STATUS + byte_data_flag + file_contents
+    nonce = urandom(12)
+    encrypted_message = aesgcm.encrypt(nonce, message, None)
+    connection.sendall(resume_flag + encryption_separator + token + encryption_separator + nonce + encryption_separator
+                       + encrypted_message + end_flag)
+
+
+def measure(make_send, frame_size, repeats):
+    server_side, client_side = socket.socketpair()
+    reader = threading.Thread(target=drain, args=(client_side, frame_size * repeats))
+    reader.start()
+    tracemalloc.start()
+    start = time.perf_counter()
+    send = make_send(server_side)
+    for _ in range(repeats):
+        send()
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    reader.join()
+    server_side.close()
+    client_side.close()
+    return elapsed / repeats, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compares the old concatenating send path with the scatter-gather one. "
+                                                 "The server sends one or two responses per connection, so the fresh "
+                                                 "connection row is the one that matches production; the reused one "
+                                                 "shows what the per-connection send buffer saves on later responses.")
+    parser.add_argument("--sizes-mb", default="1,16,64", help="download sizes in MiB")
+    parser.add_argument("--repeats", type=int, default=5)
+    args = parser.parse_args()
+
+    key = AESGCM.generate_key(bit_length=256)
+    aesgcm = AESGCM(key)
+    token_service = TokenService()
+    token = token_service.create_encryption_token(encrypted_key=b"benchmark", nonce=urandom(12), kid="benchmark")
+
+    print(f"{'size MiB':>9}{'path':>34}{'ms/send':>10}{'MiB/s':>10}{'peak alloc MiB':>16}")
+    for size_mb in map(int, args.sizes_mb.split(",")):
+        file_contents = urandom(size_mb * 2**20)
+        frame_size = (len(resume_flag) + 3 * len(encryption_separator) + len(token) + 12 + len(STATUS)
+                      + len(byte_data_flag) + len(file_contents) + 16 + len(end_flag))
+
+        def make_manager(connection):
+            manager = SecureCommunicationManager(ConnectionLifecycle(connection), token_service, None, EphemeralKeyPool(0))
+            manager.key, manager.aesgcm, manager.token = key, aesgcm, token
+            return manager
+
+        def fresh_connection_send(connection):
+            # a new manager, and so a new send buffer, for every response
+            return lambda: make_manager(connection).respond_to_client(STATUS, byte_data_flag, file_contents)
+
+        def reused_connection_send(connection):
+            manager = make_manager(connection)
+            return lambda: manager.respond_to_client(STATUS, byte_data_flag, file_contents)
+
+        for name, make_send in (("concatenating", lambda connection: lambda: concatenating_send(connection, aesgcm, token, file_contents)),
+                                ("scatter-gather, fresh connection", fresh_connection_send),
+                                ("scatter-gather, reused buffer", reused_connection_send)):
+            seconds, peak = measure(make_send, frame_size, args.repeats)
+            print(f"{size_mb:>9}{name:>34}{seconds * 1000:>10.1f}{size_mb / seconds:>10.1f}{peak / 2**20:>16.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,319 @@
+import argparse
+import json
+import logging
+import math
+import os
+import platform
+import random
+import resource
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+from Benchmarks.BenchmarkClient import BenchmarkClient
+
+SRC_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))  # the src directory
+RESULTS_DIR = os.path.join(SRC_DIR, "Benchmarks", "results")
+
+DEFAULT_MIX = "SIGN_UP=1,LOG_IN=2,GET_ITEMS_LIST=8,CREATE_FILE=4,DOWNLOAD_FILE=6"
+BENCHMARK_PASSWORD_HASH = "0" * 64
+
+
+class ServerProcess:
+    """Runs main.py in a subprocess against a temporary server_storage_path."""
+    def __init__(self, port, storage_path, log_level, workers=1):
+        self.port = port
+        self.storage_path = storage_path
+        self.log_level = log_level
+        self.workers = workers
+        self.process = None
+
+    def start(self):
+        env = dict(os.environ)
+        env["CRYPTDRIVE_SERVER_PORT"] = str(self.port)
+        env["CRYPTDRIVE_STORAGE_PATH"] = self.storage_path
+        env["CRYPTDRIVE_LOG_LEVEL"] = self.log_level
+        env["CRYPTDRIVE_WORKERS"] = str(self.workers)
+        # benchmark clients log in far more often than the rate limits allow, all from 127.0.0.1
+        for limit in ("AUTH_ATTEMPTS_PER_MINUTE_PER_IP", "AUTH_BURST_PER_IP", "LOGIN_ATTEMPTS_PER_MINUTE_PER_USER", "LOGIN_BURST_PER_USER"):
+            env[f"CRYPTDRIVE_{limit}"] = "1000000"
+        env["PYTHONPATH"] = os.pathsep.join([SRC_DIR, os.path.dirname(SRC_DIR), env.get("PYTHONPATH", "")])
+        self.process = subprocess.Popen([sys.executable, os.path.join(SRC_DIR, "main.py")], cwd=SRC_DIR, env=env)
+
+    def peak_rss_bytes(self):
+        # Sum of the VmHWM resident set high-water marks of the server and its worker processes (Linux only)
+        try:
+            with open(f"/proc/{self.process.pid}/task/{self.process.pid}/children") as children_file:
+                pids = [self.process.pid, *map(int, children_file.read().split())]
+            return sum(self._process_peak_rss_bytes(pid) for pid in pids)
+        except OSError:
+            return None
+
+    def _process_peak_rss_bytes(self, pid):
+        with open(f"/proc/{pid}/status") as status_file:
+            for line in status_file:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+        return 0
+
+    def stop(self):
+        peak_rss = self.peak_rss_bytes()
+        self.process.send_signal(signal.SIGINT)
+        try:
+            self.process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+        if peak_rss is None:
+            # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+            max_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+            peak_rss = max_rss if sys.platform == "darwin" else max_rss * 1024
+        return peak_rss
+
+
+class BenchmarkWorker(threading.Thread):
+    """One simulated user: signs up, seeds a few files and then replays the verb mix."""
+    def __init__(self, server_addr, mix, request_count, file_size, resume_sessions, raw_keys, seed):
+        super().__init__(daemon=True)
+        self.server_addr = server_addr
+        self.mix = mix
+        self.request_count = request_count
+        self.file_size = file_size
+        self.random = random.Random(seed)
+        self.client = BenchmarkClient(server_addr, resume_sessions=resume_sessions, raw_keys=raw_keys)
+        self.username = f"bench-{uuid.uuid4().hex[:12]}"
+        self.file_names = []
+        self.latencies = {}
+        self.errors = {}
+
+    def run(self):
+        self._timed("SIGN_UP", self.username, BENCHMARK_PASSWORD_HASH)
+        for _ in range(3):
+            self._create_file()
+
+        verbs, weights = zip(*self.mix.items())
+        for verb in self.random.choices(verbs, weights, k=self.request_count):
+            match verb:
+                case "SIGN_UP":
+                    # measured on a throwaway client so this worker keeps its own session and login token
+                    sign_up_client = BenchmarkClient(self.server_addr, resume_sessions=self.client.resume_sessions,
+                                                     raw_keys=self.client.raw_keys)
+                    self._timed(verb, f"bench-{uuid.uuid4().hex[:12]}", BENCHMARK_PASSWORD_HASH, client=sign_up_client)
+                case "LOG_IN":
+                    self._timed(verb, self.username, BENCHMARK_PASSWORD_HASH)
+                case "GET_ITEMS_LIST":
+                    self._timed(verb, "/")
+                case "CREATE_FILE":
+                    self._create_file()
+                case "DOWNLOAD_FILE":
+                    self._timed(verb, "/", self.random.choice(self.file_names))
+                case _:
+                    raise ValueError(f"Unsupported benchmark verb: {verb}")
+
+    def _create_file(self):
+        file_name = f"{uuid.uuid4().hex}.bin"
+        if self._timed("CREATE_FILE", "/", file_name, file_contents=os.urandom(self.file_size)):
+            self.file_names.append(file_name)
+
+    def _timed(self, verb, *data, file_contents=None, client=None):
+        client = client or self.client
+        start = time.perf_counter()
+        try:
+            status_parts, _ = client.request(verb, *data, file_contents=file_contents)
+            succeeded = status_parts[0] == "SUCCESS"
+        except (OSError, ValueError) as exception:
+            logging.debug(f"{verb} failed: {exception}")
+            client.aesgcm = None  # force a fresh handshake on the next request
+            succeeded = False
+        elapsed = time.perf_counter() - start
+
+        if succeeded:
+            self.latencies.setdefault(verb, []).append(elapsed)
+        else:
+            self.errors[verb] = self.errors.get(verb, 0) + 1
+        return succeeded
+
+
+def percentile(sorted_values, fraction):
+    # nearest-rank percentile
+    if not sorted_values:
+        return None
+    index = max(0, math.ceil(fraction * len(sorted_values)) - 1)
+    return sorted_values[index]
+
+
+def summarize(workers, wall_time):
+    verbs = {}
+    for verb in sorted({verb for worker in workers for verb in (*worker.latencies, *worker.errors)}):
+        latencies = sorted(latency for worker in workers for latency in worker.latencies.get(verb, []))
+        verbs[verb] = {
+            "count": len(latencies),
+            "errors": sum(worker.errors.get(verb, 0) for worker in workers),
+            "throughput_per_s": len(latencies) / wall_time if wall_time > 0 else 0.0,
+            "p50_ms": percentile(latencies, 0.50) * 1000 if latencies else None,
+            "p99_ms": percentile(latencies, 0.99) * 1000 if latencies else None,
+            "mean_ms": sum(latencies) / len(latencies) * 1000 if latencies else None,
+        }
+    return verbs
+
+
+def compare(results, baseline, threshold):
+    """Prints per verb deltas against a baseline results file and returns the metrics that regressed."""
+    regressions = []
+    print(f"\n{'verb':<16}{'metric':<18}{'baseline':>12}{'current':>12}{'change':>10}")
+    for verb, current in results["verbs"].items():
+        previous = baseline["verbs"].get(verb)
+        if previous is None:
+            continue
+        for metric, higher_is_better in (("throughput_per_s", True), ("p50_ms", False), ("p99_ms", False)):
+            if not previous.get(metric) or current.get(metric) is None:
+                continue
+            change = (current[metric] - previous[metric]) / previous[metric]
+            print(f"{verb:<16}{metric:<18}{previous[metric]:>12.2f}{current[metric]:>12.2f}{change:>+10.1%}")
+            if (-change if higher_is_better else change) > threshold:
+                regressions.append(f"{verb} {metric}")
+
+    previous_rss, current_rss = baseline.get("server_peak_rss_bytes"), results.get("server_peak_rss_bytes")
+    if previous_rss and current_rss:
+        change = (current_rss - previous_rss) / previous_rss
+        print(f"{'server':<16}{'peak_rss_mb':<18}{previous_rss / 2**20:>12.2f}{current_rss / 2**20:>12.2f}{change:>+10.1%}")
+        if change > threshold:
+            regressions.append("server peak_rss")
+    return regressions
+
+
+def parse_mix(mix):
+    parsed = {}
+    for part in mix.split(","):
+        verb, weight = part.split("=")
+        parsed[verb.strip().upper()] = float(weight)
+    return parsed
+
+
+def get_free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as probe:
+        probe.bind(("127.0.0.1", 0))
+        return probe.getsockname()[1]
+
+
+def wait_for_server(server_addr, server_process, timeout=30):
+    # A real request instead of a bare connect, so the probe does not leave a half-open connection on the server
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if server_process.process.poll() is not None:
+            raise RuntimeError("Server exited during startup")
+        try:
+            BenchmarkClient(server_addr, timeout=5).request("SIGN_UP", f"warmup-{uuid.uuid4().hex[:12]}", BENCHMARK_PASSWORD_HASH)
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise TimeoutError("Server did not become ready")
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=SRC_DIR, capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return None
+
+
+def run_benchmark(args):
+    mix = parse_mix(args.mix)
+    port = args.port or get_free_port()
+    server_addr = ("127.0.0.1", port)
+
+    with tempfile.TemporaryDirectory(prefix="cryptdrive-bench-") as storage_path:
+        server_process = ServerProcess(port, storage_path, args.server_log_level, args.workers)
+        server_process.start()
+        try:
+            wait_for_server(server_addr, server_process)
+
+            workers = [BenchmarkWorker(server_addr, mix, args.requests, args.file_size, not args.no_resume, args.raw_keys,
+                                       args.seed + i) for i in range(args.clients)]
+            start = time.perf_counter()
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+            wall_time = time.perf_counter() - start
+        finally:
+            peak_rss = server_process.stop()
+
+    return {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "git_revision": git_revision(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "config": {
+                "clients": args.clients,
+                "server_workers": args.workers,
+                "requests_per_client": args.requests,
+                "mix": mix,
+                "file_size": args.file_size,
+                "resume_sessions": not args.no_resume,
+                "raw_keys": args.raw_keys,
+                "seed": args.seed,
+            },
+        },
+        "wall_time_s": wall_time,
+        "handshakes": sum(worker.client.handshakes for worker in workers),
+        "verbs": summarize(workers, wall_time),
+        "server_peak_rss_bytes": peak_rss,
+    }
+
+
+def print_results(results):
+    print(f"\n{'verb':<16}{'count':>8}{'errors':>8}{'req/s':>10}{'p50 ms':>10}{'p99 ms':>10}")
+    for verb, stats in results["verbs"].items():
+        p50 = f"{stats['p50_ms']:.2f}" if stats["p50_ms"] is not None else "-"
+        p99 = f"{stats['p99_ms']:.2f}" if stats["p99_ms"] is not None else "-"
+        print(f"{verb:<16}{stats['count']:>8}{stats['errors']:>8}{stats['throughput_per_s']:>10.1f}{p50:>10}{p99:>10}")
+    if results["server_peak_rss_bytes"]:
+        print(f"Server peak RSS: {results['server_peak_rss_bytes'] / 2**20:.1f} MiB")
+    print(f"Wall time: {results['wall_time_s']:.2f}s, handshakes: {results['handshakes']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load-generating benchmark for the CryptDrive server.")
+    parser.add_argument("--clients", type=int, default=8, help="number of concurrent clients")
+    parser.add_argument("--requests", type=int, default=50, help="requests per client, after setup")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help=f"weighted verb mix (default: {DEFAULT_MIX})")
+    parser.add_argument("--file-size", type=int, default=16 * 1024, help="size in bytes of uploaded files")
+    parser.add_argument("--workers", type=int, default=1, help="server worker processes")
+    parser.add_argument("--no-resume", action="store_true", help="perform a full handshake on every request")
+    parser.add_argument("--raw-keys", action="store_true", help="send raw 32-byte X25519 public keys instead of PEM")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--port", type=int, default=0, help="server port (default: a free port)")
+    parser.add_argument("--server-log-level", default="WARNING")
+    parser.add_argument("--output", help="results file (default: Benchmarks/results/<timestamp>.json)")
+    parser.add_argument("--compare", help="baseline results file to compare against")
+    parser.add_argument("--threshold", type=float, default=0.10, help="relative change reported as a regression")
+    args = parser.parse_args()
+
+    results = run_benchmark(args)
+    print_results(results)
+
+    output = args.output or os.path.join(RESULTS_DIR, f"{time.strftime('%Y%m%d-%H%M%S')}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as file:
+        json.dump(results, file, indent=2)
+    print(f"Results written to {output}")
+
+    if args.compare:
+        with open(args.compare) as file:
+            regressions = compare(results, json.load(file), args.threshold)
+        if regressions:
+            print(f"Regressions over {args.threshold:.0%}: {', '.join(regressions)}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main()
@@ -1,10 +1,12 @@
 import logging
 import peewee
 import os
-from Dependencies.Constants import server_storage_path
+import sqlite3
+from DAOs.TracedSqliteDatabase import TracedSqliteDatabase
+from Dependencies.Constants import server_storage_path, sqlite_pragmas
 
 db_path = os.path.join(server_storage_path, "Files.db")
-files_db = peewee.SqliteDatabase(db_path)
+files_db = TracedSqliteDatabase(db_path, pragmas=sqlite_pragmas)
 # shared_db_path = os.path.join(server_storage_path, "SharedFiles.db")
 # shared_files_db = peewee.SqliteDatabase(shared_db_path)
 
@@ -20,7 +22,54 @@ class FilesDB(peewee.Model):
     class Meta:
         database = files_db
         indexes = (
-        (("file_owner_id", "user_file_path", "user_file_name", "is_directory"), True),)
+        (("file_owner_id", "user_file_path", "user_file_name", "is_directory"), True),
+        (("file_owner_id", "file_uuid"), False),
+        (("file_owner_id",), False),)  # rows of an owner in file_id order, for paging through search results
+
+# Trigram full-text index over names and paths for SEARCH, shared by all owners. Each row also carries an owner tag:
+# the owner id as three private-use characters, exactly one trigram. SEARCH matches the tag against the owner_tag
+# column only, which keeps owners apart and lets MATCH walk just the owner's own hits; a name or path that happens
+# to contain the same characters is never compared with it. The index is contentless (rows are read from filesdb),
+# and the triggers keep it in step with every insert, delete, rename and move, whichever code path makes them.
+owner_tag_sql = "char(57344 + ({id} / 40960000) % 6400, 57344 + ({id} / 6400) % 6400, 57344 + {id} % 6400)"
+search_index_statements = (
+    """CREATE VIRTUAL TABLE IF NOT EXISTS files_search_by_owner USING fts5(
+        owner_tag, user_file_name, user_file_path, content='', tokenize='trigram')""",
+    f"""CREATE TRIGGER IF NOT EXISTS files_search_by_owner_insert AFTER INSERT ON filesdb BEGIN
+        INSERT INTO files_search_by_owner(rowid, owner_tag, user_file_name, user_file_path)
+        VALUES (new.file_id, {owner_tag_sql.format(id="new.file_owner_id")}, new.user_file_name, new.user_file_path);
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS files_search_by_owner_delete AFTER DELETE ON filesdb BEGIN
+        INSERT INTO files_search_by_owner(files_search_by_owner, rowid, owner_tag, user_file_name, user_file_path)
+        VALUES ('delete', old.file_id, {owner_tag_sql.format(id="old.file_owner_id")}, old.user_file_name, old.user_file_path);
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS files_search_by_owner_update AFTER UPDATE OF user_file_name, user_file_path ON filesdb BEGIN
+        INSERT INTO files_search_by_owner(files_search_by_owner, rowid, owner_tag, user_file_name, user_file_path)
+        VALUES ('delete', old.file_id, {owner_tag_sql.format(id="old.file_owner_id")}, old.user_file_name, old.user_file_path);
+        INSERT INTO files_search_by_owner(rowid, owner_tag, user_file_name, user_file_path)
+        VALUES (new.file_id, {owner_tag_sql.format(id="new.file_owner_id")}, new.user_file_name, new.user_file_path);
+    END""",
+)
+populate_search_index_sql = (f"INSERT INTO files_search_by_owner(rowid, owner_tag, user_file_name, user_file_path) "
+                             f"SELECT file_id, {owner_tag_sql.format(id='file_owner_id')}, user_file_name, user_file_path FROM filesdb")
+search_index_min_sqlite_version = (3, 34, 0)  # first version with the trigram tokenizer
+search_trigram_length = 3  # shorter queries can't use the index and scan the owner's rows instead
+
+# Hot lookups skip the query builder and model instantiation. The SQL text is constant, so sqlite3's statement
+# cache prepares each statement once per connection. "IS ?" rather than "= ?" so a None path matches the root dir.
+file_record_columns = "file_id, file_owner_id, user_file_path, user_file_name, file_uuid, file_size, is_directory"
+select_item_sql = (f"SELECT {file_record_columns} FROM filesdb "
+                   "WHERE file_owner_id = ? AND user_file_path IS ? AND user_file_name = ? AND is_directory = ? LIMIT 1")
+does_item_exist_sql = ("SELECT 1 FROM filesdb "
+                       "WHERE file_owner_id = ? AND user_file_path IS ? AND user_file_name = ? AND is_directory = ? LIMIT 1")
+select_file_uuid_sql = ("SELECT file_uuid FROM filesdb "
+                        "WHERE file_owner_id = ? AND user_file_path IS ? AND user_file_name = ? AND is_directory = 0 LIMIT 1")
+select_items_in_path_sql = (f"SELECT {file_record_columns} FROM filesdb "
+                            "WHERE file_owner_id = ? AND user_file_path IS ? AND is_directory = ?")
+count_items_in_path_sql = "SELECT COUNT(*) FROM filesdb WHERE file_owner_id = ? AND user_file_path IS ?"
+select_items_under_path_sql = (f"SELECT {file_record_columns} FROM filesdb "
+                               "WHERE file_owner_id = ? AND (user_file_path = ? OR substr(user_file_path, 1, ?) = ?)")
+delete_item_by_id_sql = "DELETE FROM filesdb WHERE file_id = ?"
 
 # class FilesSharedDB(peewee.Model):
 #     share_id = peewee.AutoField()
@@ -33,30 +82,55 @@ class FilesDB(peewee.Model):
 #             (("file_owner_id", "user_file_path", "user_file_name", "is_directory"), True),)
 
 
+class FileRecord:
+    """A FilesDB row read through the raw query path, with the same attribute names as the model."""
+    __slots__ = ("file_id", "file_owner_id", "user_file_path", "user_file_name", "file_uuid", "file_size", "is_directory")
+
+    def __init__(self, file_id, file_owner_id, user_file_path, user_file_name, file_uuid, file_size, is_directory):
+        self.file_id = file_id
+        self.file_owner_id = file_owner_id
+        self.user_file_path = user_file_path
+        self.user_file_name = user_file_name
+        self.file_uuid = file_uuid
+        self.file_size = file_size
+        self.is_directory = bool(is_directory)
+
+
 class FilesDatabaseDAO:
     def __init__(self):
         files_db.connect()
         logging.debug(f"Connected to the Database at {db_path}.")
         files_db.create_tables([FilesDB])
+        self.search_index_available = self._create_search_index()
 
     def create_file(self, file_owner_id, user_file_path, file_uuid, user_file_name, file_size):
-        FilesDB.create(
-            file_owner_id=file_owner_id,
-            user_file_path=user_file_path,
-            file_uuid=file_uuid,
-            user_file_name=user_file_name,
-            file_size=file_size
-        )
+        """Returns False if the file already exists."""
+        try:
+            FilesDB.create(
+                file_owner_id=file_owner_id,
+                user_file_path=user_file_path,
+                file_uuid=file_uuid,
+                user_file_name=user_file_name,
+                file_size=file_size
+            )
+        except peewee.IntegrityError:
+            return False
         logging.debug(f"File {user_file_name} created in {file_owner_id}@{user_file_path} in the Database.")
+        return True
 
     def delete_file(self, file_owner_id, user_file_path, user_file_name):
         FilesDB.delete().where(
             FilesDB.user_file_name == user_file_name,
             FilesDB.file_owner_id == file_owner_id,
-            FilesDB.user_file_path == user_file_path
+            FilesDB.user_file_path == user_file_path,
+            FilesDB.is_directory == False
         ).execute()
         logging.debug(f"File {user_file_name} deleted from {file_owner_id}/{user_file_path} in the Database.")
 
+    def delete_file_by_id(self, file_id):
+        files_db.execute_sql(delete_item_by_id_sql, (file_id,))
+        logging.debug(f"File {file_id} deleted from the Database.")
+
     def create_dir(self, file_owner_id, user_file_path, user_file_name):
         FilesDB.create(
             file_owner_id=file_owner_id,
@@ -76,48 +150,29 @@ class FilesDatabaseDAO:
         logging.debug(f"Directory {user_dir_name} deleted from {file_owner_id}/{user_dir_path} in the Database.")
 
     def get_file_uuid(self, file_owner_id, user_file_path, user_file_name):
-        return FilesDB.select().where(
-            FilesDB.file_owner_id == file_owner_id,
-            FilesDB.user_file_path == user_file_path,
-            FilesDB.user_file_name == user_file_name,
-            FilesDB.is_directory == False
-        ).get().file_uuid
+        """Returns None if there is no such file."""
+        row = files_db.execute_sql(select_file_uuid_sql, (file_owner_id, user_file_path, user_file_name)).fetchone()
+        return row[0] if row is not None else None
+
+    def get_file(self, file_owner_id, user_file_path, user_file_name):
+        """Returns a FileRecord, or None if there is no such file."""
+        row = files_db.execute_sql(select_item_sql, (file_owner_id, user_file_path, user_file_name, False)).fetchone()
+        return FileRecord(*row) if row is not None else None
 
     def does_file_exist(self, file_owner_id, user_file_path, user_file_name):
-        return FilesDB.select().where(
-            FilesDB.file_owner_id == file_owner_id,
-            FilesDB.user_file_path == user_file_path,
-            FilesDB.user_file_name == user_file_name,
-            FilesDB.is_directory == False
-        ).exists()
+        return files_db.execute_sql(does_item_exist_sql, (file_owner_id, user_file_path, user_file_name, False)).fetchone() is not None
 
     def get_all_files_in_path(self, file_owner_id, path):
-        return list(FilesDB.select().where(
-            FilesDB.file_owner_id == file_owner_id,
-            FilesDB.user_file_path == path,
-            FilesDB.is_directory == False
-        ))
+        return [FileRecord(*row) for row in files_db.execute_sql(select_items_in_path_sql, (file_owner_id, path, False))]
 
     def get_all_dirs_in_path(self, file_owner_id, path):
-        return list(FilesDB.select().where(
-            FilesDB.file_owner_id == file_owner_id,
-            FilesDB.user_file_path == path,
-            FilesDB.is_directory == True
-        ))
+        return [FileRecord(*row) for row in files_db.execute_sql(select_items_in_path_sql, (file_owner_id, path, True))]
 
     def get_item_count_for_dir(self, file_owner_id, path):
-        return len(list(FilesDB.select().where(
-            FilesDB.file_owner_id == file_owner_id,
-            FilesDB.user_file_path == path,
-        )))
+        return files_db.execute_sql(count_items_in_path_sql, (file_owner_id, path)).fetchone()[0]
 
     def does_dir_exist(self, file_owner_id, dir_path, dir_name):
-        return FilesDB.select().where(
-            FilesDB.file_owner_id == file_owner_id,
-            FilesDB.user_file_path == dir_path,
-            FilesDB.user_file_name == dir_name,
-            FilesDB.is_directory == True
-        ).exists()
+        return files_db.execute_sql(does_item_exist_sql, (file_owner_id, dir_path, dir_name, True)).fetchone() is not None
 
     def rename_and_move_file(self, file_owner_id, old_user_file_path, new_user_file_path, old_user_file_name, new_user_file_name):
         FilesDB.update(user_file_path=new_user_file_path, user_file_name=new_user_file_name).where(
@@ -135,6 +190,109 @@ class FilesDatabaseDAO:
             FilesDB.is_directory == True
         ).execute()
 
+    def get_all_items_under_path(self, file_owner_id, path):
+        """Files and directories in path and, recursively, in all of its subdirectories."""
+        params = (file_owner_id, path, len(path) + 1, path + "/")
+        return [FileRecord(*row) for row in files_db.execute_sql(select_items_under_path_sql, params)]
+
+    def create_items(self, items):
+        """Inserts rows given as dicts of FilesDB fields in one transaction. Returns False, inserting none, if any exists."""
+        try:
+            with files_db.atomic():
+                for batch in peewee.chunked(items, 500):
+                    FilesDB.insert_many(batch).execute()
+        except peewee.IntegrityError:
+            return False
+        logging.debug(f"{len(items)} items created in the Database.")
+        return True
+
+    def get_file_sizes_by_uuid(self, file_owner_id, file_uuids):
+        return {file.file_uuid: file.file_size for file in FilesDB.select(FilesDB.file_uuid, FilesDB.file_size).where(
+            FilesDB.file_owner_id == file_owner_id,
+            FilesDB.file_uuid.in_(file_uuids),
+            FilesDB.is_directory == False
+        )}
+
+    def get_files_after_id(self, file_id, limit):
+        return list(FilesDB.select(FilesDB.file_id, FilesDB.file_owner_id, FilesDB.file_uuid, FilesDB.file_size).where(
+            FilesDB.file_id > file_id,
+            FilesDB.is_directory == False
+        ).order_by(FilesDB.file_id).limit(limit))
+
+    def does_file_id_exist(self, file_id):
+        return FilesDB.select().where(FilesDB.file_id == file_id).exists()
+
+    def search(self, file_owner_id, query, prefix_only, is_directory, min_size, max_size, after_file_id, limit):
+        """
+        Items of the owner whose name or path contains query (or whose name starts with it, with prefix_only),
+        ordered by file_id and starting after after_file_id. is_directory, min_size and max_size may be None.
+        Returns (file_id, user_file_path, user_file_name, is_directory, file_size) tuples.
+        """
+        if len(query) >= search_trigram_length and self.search_index_available:
+            # the rowid order of the index doubles as the pagination order
+            id_column = "files_search_by_owner.rowid"
+            sql = ("SELECT f.file_id, f.user_file_path, f.user_file_name, f.is_directory, f.file_size "
+                   "FROM files_search_by_owner JOIN filesdb AS f ON f.file_id = files_search_by_owner.rowid WHERE files_search_by_owner MATCH ? AND ")
+            conditions = [f"{id_column} > ?", "f.file_owner_id = ?", "f.user_file_path IS NOT NULL"]
+            match = f'owner_tag : "{self._owner_tag(file_owner_id)}" AND {{user_file_name user_file_path}} : "{query.replace('"', '""')}"'
+            params = [match, after_file_id, file_owner_id]
+        else:
+            id_column = "f.file_id"
+            sql = "SELECT f.file_id, f.user_file_path, f.user_file_name, f.is_directory, f.file_size FROM filesdb AS f WHERE "
+            conditions = [f"{id_column} > ?", "f.file_owner_id = ?", "f.user_file_path IS NOT NULL"]
+            params = [after_file_id, file_owner_id]
+            if query:
+                conditions.append("(instr(lower(f.user_file_name), lower(?)) > 0 OR instr(lower(f.user_file_path), lower(?)) > 0)")
+                params += [query, query]
+        if prefix_only:
+            conditions.append("lower(substr(f.user_file_name, 1, ?)) = lower(?)")
+            params += [len(query), query]
+        if is_directory is not None:
+            conditions.append("f.is_directory = ?")
+            params.append(is_directory)
+        if min_size is not None:
+            conditions.append("f.file_size >= ?")
+            params.append(min_size)
+        if max_size is not None:
+            conditions.append("f.file_size <= ?")
+            params.append(max_size)
+        sql += " AND ".join(conditions) + f" ORDER BY {id_column} LIMIT ?"
+        params.append(limit)
+        return files_db.execute_sql(sql, params).fetchall()
+
+    def _create_search_index(self):
+        """Returns False where SQLite can't build the index; SEARCH then scans the owner's rows instead."""
+        if sqlite3.sqlite_version_info < search_index_min_sqlite_version:
+            logging.warning(f"SQLite {sqlite3.sqlite_version} has no trigram tokenizer. SEARCH will scan rows instead of using an index.")
+            self._drop_search_index()
+            return False
+        try:
+            with files_db.atomic():
+                # the triggers are created last, so without them the index may be missing rows and is built again
+                is_new = files_db.execute_sql("SELECT 1 FROM sqlite_master WHERE type = 'trigger' AND name = 'files_search_by_owner_insert'").fetchone() is None
+                if is_new:
+                    files_db.execute_sql("DROP TABLE IF EXISTS files_search_by_owner")
+                for statement in search_index_statements:
+                    files_db.execute_sql(statement)
+                if is_new:
+                    # index the rows that existed before the search index did
+                    files_db.execute_sql(populate_search_index_sql)
+                    logging.info("Built the search index for FilesDB.")
+        except peewee.OperationalError as exception:
+            # e.g. SQLite built without FTS5
+            logging.warning(f"Could not create the search index ({exception}). SEARCH will scan rows instead of using an index.")
+            self._drop_search_index()
+            return False
+        return True
+
+    def _drop_search_index(self):
+        # triggers left by a newer SQLite would make every insert fail here
+        for statement in ("DROP TRIGGER IF EXISTS files_search_by_owner_insert", "DROP TRIGGER IF EXISTS files_search_by_owner_delete",
+                          "DROP TRIGGER IF EXISTS files_search_by_owner_update"):
+            files_db.execute_sql(statement)
+
+    def _owner_tag(self, file_owner_id):
+        return "".join(chr(57344 + part % 6400) for part in (file_owner_id // 40960000, file_owner_id // 6400, file_owner_id))
 
     def close_db(self):
         files_db.close()
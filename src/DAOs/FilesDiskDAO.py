@@ -1,41 +1,259 @@
+import errno
 import logging
 import os
+import re
+import shutil
+import threading
+import time
+from collections import Counter
 
-from Dependencies.Constants import server_storage_path
+from DAOs.FsyncBatcher import FsyncBatcher
+from Dependencies.Constants import server_storage_path, storage_shard_levels, storage_shard_width, storage_temp_path, \
+    stale_temp_file_seconds, copy_batch_size, copy_chunk_size, write_batch_size
+from Dependencies.RequestTracer import request_tracer
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+blob_name_pattern = re.compile(r"^[0-9a-f]{32}$")  # FileService names blobs with uuid4().hex
+ficlone_request = 0x40049409  # FICLONE from linux/fs.h: the destination shares the source's extents
+# errors meaning the filesystem or kernel can't do this kind of copy, as opposed to a failed copy
+unsupported_copy_errors = (errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.ENOTTY, errno.EOPNOTSUPP, errno.EBADF)
 
 
 class FilesDiskDAO:
-    def __init__(self):
-        pass
+    """
+    Blobs are stored as <server_storage_path>/<owner_id>/<shard>/.../<file_uuid>, where each of the
+    storage_shard_levels shard directories is the next storage_shard_width characters of the uuid.
+    Blobs written before sharding live directly in <owner_id>/; reads and deletes look in both places
+    until StorageMigrationService has moved them.
+    """
+    def __init__(self, shard_levels=storage_shard_levels, shard_width=storage_shard_width):
+        self.shard_levels = shard_levels
+        self.shard_width = shard_width
+        self.created_dirs = set()  # so uploads don't call os.makedirs every time
+        self.fsync_batcher = FsyncBatcher()
+        self.reflinks_supported = fcntl is not None
+        self.copy_file_range_supported = hasattr(os, "copy_file_range")
+        self._copies_lock = threading.Lock()
+        self.copies = Counter()  # blobs copied, by method
+        self.ensure_dir_exists(storage_temp_path)
+        self._remove_stale_temp_files()
 
     def write_file_to_disk(self, file_owner_id, file_uuid, file_contents):
-        os.makedirs(os.path.join(server_storage_path, str(file_owner_id)), exist_ok=True)
+        """
+        Writes the blob to a temp file, makes it durable, then renames it into place and makes the rename durable.
+        Once this returns the blob survives a crash, so metadata may point at it; a crash before that leaves at
+        most a temp file, never a partially written blob under its final name.
+        """
         full_file_path = self.get_full_file_path(file_owner_id, file_uuid)
-        with open(full_file_path, "xb") as file:
-            file.write(file_contents)
+        temp_file_path = os.path.join(storage_temp_path, f"{file_uuid}.{os.getpid()}.part")
+        with request_tracer.span("disk_io"):
+            try:
+                with open(temp_file_path, "xb") as file:
+                    file.write(file_contents)
+                    file.flush()
+                    self.fsync_batcher.sync(file.fileno())
+                dir_paths = self._rename_into_place(temp_file_path, full_file_path)
+            except BaseException:
+                if os.path.exists(temp_file_path):
+                    os.remove(temp_file_path)
+                raise
+            self.fsync_batcher.sync_many(dir_paths)
         logging.debug(f"File {full_file_path} written to disk.")
 
+    def copy_files_on_disk(self, file_owner_id, file_uuid_pairs):
+        """
+        Copies the blobs of (source_uuid, new_uuid) pairs without passing their contents through Python: by reflink
+        where the filesystem supports it, else with os.copy_file_range, else in copy_chunk_size chunks.
+        Each copy gets the durability of write_file_to_disk, with the fsyncs of copy_batch_size blobs batched together.
+        """
+        with request_tracer.span("disk_io"):
+            for start in range(0, len(file_uuid_pairs), copy_batch_size):
+                self._copy_batch(file_owner_id, file_uuid_pairs[start:start + copy_batch_size])
+
+    def write_files_to_disk(self, file_owner_id, files):
+        """
+        write_file_to_disk for a list of (file_uuid, file_contents), with the fsyncs of write_batch_size blobs
+        batched together like those of copy_files_on_disk.
+        """
+        with request_tracer.span("disk_io"):
+            for start in range(0, len(files), write_batch_size):
+                self._write_batch(file_owner_id, files[start:start + write_batch_size])
+        logging.debug(f"{len(files)} files written to disk for {file_owner_id}.")
+
+    def get_copy_stats(self):
+        with self._copies_lock:
+            return {
+                "reflinks_supported": self.reflinks_supported,
+                "copy_file_range_supported": self.copy_file_range_supported,
+                **self.copies,
+            }
+
     def get_file_size_on_disk(self, file_owner_id, file_uuid):
-        full_file_path = self.get_full_file_path(file_owner_id, file_uuid)
-        return os.path.getsize(full_file_path)
+        with request_tracer.span("disk_io"):
+            return self._in_either_layout(file_owner_id, file_uuid, os.path.getsize)
 
     def get_file_contents(self, file_owner_id, file_uuid):
         logging.debug(f"Getting file contents from {file_owner_id}/{file_uuid}.")
-        full_file_path = self.get_full_file_path(file_owner_id, file_uuid)
-        with open(full_file_path, "rb") as file:
-            file_contents = file.read(-1)
-        return file_contents
+        with request_tracer.span("disk_io"):
+            return self._in_either_layout(file_owner_id, file_uuid, self._read_file)
 
     def delete_file_from_disk(self, file_owner_id, file_uuid):
-        os.remove(self.get_full_file_path(file_owner_id, file_uuid))
+        with request_tracer.span("disk_io"):
+            self._in_either_layout(file_owner_id, file_uuid, os.remove)
 
     def get_full_file_path(self, file_owner_id, file_uuid):
+        file_uuid = str(file_uuid)
+        shards = [file_uuid[level * self.shard_width:(level + 1) * self.shard_width] for level in range(self.shard_levels)]
+        return os.path.join(server_storage_path, str(file_owner_id), *shards, file_uuid)
+
+    def get_flat_file_path(self, file_owner_id, file_uuid):
         return os.path.join(server_storage_path, str(file_owner_id), str(file_uuid))
 
+    def ensure_dir_exists(self, dir_path):
+        """Returns True the first time this DAO sees the directory, after creating it if needed."""
+        if dir_path in self.created_dirs:
+            return False
+        os.makedirs(dir_path, exist_ok=True)
+        self.created_dirs.add(dir_path)
+        return True
+
+    def _rename_into_place(self, temp_file_path, full_file_path):
+        """Renames a durable temp file to its blob path and returns the directories whose entries must be synced."""
+        created_dir = self.ensure_dir_exists(os.path.dirname(full_file_path))
+        os.rename(temp_file_path, full_file_path)
+        dir_path = os.path.dirname(full_file_path)
+        dir_paths = [dir_path]
+        while created_dir and dir_path != os.fspath(server_storage_path):
+            # new shard directories also need their own entries made durable
+            dir_path = os.path.dirname(dir_path)
+            dir_paths.append(dir_path)
+        return dir_paths
+
+    def _copy_batch(self, file_owner_id, file_uuid_pairs):
+        temp_files = []
+        try:
+            for source_uuid, new_uuid in file_uuid_pairs:
+                with self._in_either_layout(file_owner_id, source_uuid, lambda path: open(path, "rb")) as source:
+                    destination = self._open_temp_file(file_owner_id, new_uuid, temp_files)
+                    self._copy_contents(source, destination)
+                    destination.flush()
+        except BaseException:
+            self._discard_temp_files(temp_files)
+            raise
+        self._place_temp_files(temp_files)
+
+    def _write_batch(self, file_owner_id, files):
+        temp_files = []
+        try:
+            for file_uuid, file_contents in files:
+                destination = self._open_temp_file(file_owner_id, file_uuid, temp_files)
+                destination.write(file_contents)
+                destination.flush()
+        except BaseException:
+            self._discard_temp_files(temp_files)
+            raise
+        self._place_temp_files(temp_files)
+
+    def _open_temp_file(self, file_owner_id, file_uuid, temp_files):
+        temp_file_path = os.path.join(storage_temp_path, f"{file_uuid}.{os.getpid()}.part")
+        destination = open(temp_file_path, "xb")
+        temp_files.append((temp_file_path, self.get_full_file_path(file_owner_id, file_uuid), destination))
+        return destination
+
+    def _place_temp_files(self, temp_files):
+        """Syncs a batch of written temp files together, renames them into place and syncs the renames."""
+        dir_paths = []
+        try:
+            self.fsync_batcher.sync_many([destination.fileno() for _, _, destination in temp_files])
+            for temp_file_path, full_file_path, destination in temp_files:
+                destination.close()
+                dir_paths.extend(self._rename_into_place(temp_file_path, full_file_path))
+        except BaseException:
+            self._discard_temp_files(temp_files)
+            raise
+        self.fsync_batcher.sync_many(dir_paths)
+
+    def _discard_temp_files(self, temp_files):
+        for temp_file_path, _, destination in temp_files:
+            destination.close()
+            if os.path.exists(temp_file_path):
+                os.remove(temp_file_path)
+
+    def _copy_contents(self, source, destination):
+        method = "chunked"
+        if self.reflinks_supported and self._try_reflink(source, destination):
+            method = "reflink"
+        elif self.copy_file_range_supported and self._try_copy_file_range(source, destination):
+            method = "copy_file_range"
+        else:
+            shutil.copyfileobj(source, destination, copy_chunk_size)
+        with self._copies_lock:
+            self.copies[method] += 1
+
+    def _try_reflink(self, source, destination):
+        try:
+            fcntl.ioctl(destination.fileno(), ficlone_request, source.fileno())
+            return True
+        except OSError as exception:
+            if exception.errno not in unsupported_copy_errors:
+                raise
+            # the blobs all live on one filesystem, so there is no point in trying again
+            logging.info(f"Reflinks not supported in {server_storage_path}: {exception}")
+            self.reflinks_supported = False
+            return False
+
+    def _try_copy_file_range(self, source, destination):
+        remaining = os.fstat(source.fileno()).st_size
+        copied_any = False
+        try:
+            while remaining > 0:
+                copied = os.copy_file_range(source.fileno(), destination.fileno(), remaining)
+                if copied == 0:
+                    # some filesystems report 0 instead of an error part way; both offsets have advanced, so copy the rest by hand
+                    shutil.copyfileobj(source, destination, copy_chunk_size)
+                    break
+                remaining -= copied
+                copied_any = True
+            return True
+        except OSError as exception:
+            if copied_any or exception.errno not in unsupported_copy_errors:
+                raise
+            logging.info(f"copy_file_range not supported in {server_storage_path}: {exception}")
+            self.copy_file_range_supported = False
+            return False
+
+    def _in_either_layout(self, file_owner_id, file_uuid, operation):
+        sharded_path = self.get_full_file_path(file_owner_id, file_uuid)
+        try:
+            return operation(sharded_path)
+        except FileNotFoundError:
+            pass
+        try:
+            return operation(self.get_flat_file_path(file_owner_id, file_uuid))
+        except FileNotFoundError:
+            # the migration may have moved the blob between the two attempts
+            return operation(sharded_path)
+
+    def _remove_stale_temp_files(self):
+        # temp files left behind by a crash; recent ones may belong to uploads of other worker processes
+        with os.scandir(storage_temp_path) as entries:
+            for entry in entries:
+                if entry.name.endswith(".part") and entry.stat().st_mtime < time.time() - stale_temp_file_seconds:
+                    logging.info(f"Removing stale temp file {entry.path}")
+                    os.remove(entry.path)
+
+    def _read_file(self, full_file_path):
+        with open(full_file_path, "rb") as file:
+            return file.read(-1)
+
 
 if __name__ == "__main__":
     logging.basicConfig(level=logging.DEBUG)
 
     a = FilesDiskDAO()
     print(a.get_file_size_on_disk(123, "kjhgfcvbhjygfdcvbhytfdxcvbgfdx"))
-    print(a.get_file_contents(123, "kjhgfcvbhjygfdcvbhytfdxcvbgfdx"))
\ No newline at end of file
+    print(a.get_file_contents(123, "kjhgfcvbhjygfdcvbhytfdxcvbgfdx"))
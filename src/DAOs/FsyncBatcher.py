@@ -0,0 +1,98 @@
+import logging
+import os
+import threading
+import time
+
+from Dependencies.Constants import fsync_batch_window_ms
+
+
+class FsyncRequest:
+    __slots__ = ("target", "done", "error")
+
+    def __init__(self, target):
+        self.target = target  # an open file descriptor or a directory path
+        self.done = False
+        self.error = None
+
+
+class FsyncBatcher:
+    """
+    Group commit for fsync. Callers block in sync() until a flusher thread has synced their target together with
+    everything else requested during the same fsync_batch_window_ms window. Directory syncs requested in a batch are
+    deduplicated, and the journal commits of the filesystem are shared between the uploads of a batch.
+    With a window of 0, every sync happens inline on the caller's thread.
+    """
+    def __init__(self, window_ms=fsync_batch_window_ms):
+        self.window = window_ms / 1000
+        self._condition = threading.Condition()
+        self._pending = []
+        self.batches = 0
+        self.synced = 0
+        if self.window > 0:
+            threading.Thread(target=self._flush_batches, name="FsyncBatcher", daemon=True).start()
+
+    def sync(self, target):
+        self.sync_many([target])
+
+    def sync_many(self, targets):
+        """Syncs all targets in the same batch and returns once every one of them is durable."""
+        if self.window <= 0:
+            for target in dict.fromkeys(targets):
+                self._fsync(target)
+            return
+
+        requests = [FsyncRequest(target) for target in targets]
+        with self._condition:
+            self._pending.extend(requests)
+            self._condition.notify_all()
+            while not all(request.done for request in requests):
+                self._condition.wait()
+        for request in requests:
+            if request.error is not None:
+                raise request.error
+
+    def get_stats(self):
+        with self._condition:
+            return {
+                "window_ms": self.window * 1000,
+                "batches": self.batches,
+                "synced": self.synced,
+            }
+
+    def _flush_batches(self):
+        while True:
+            with self._condition:
+                while not self._pending:
+                    self._condition.wait()
+            time.sleep(self.window)  # let concurrent uploads join the batch
+            with self._condition:
+                batch, self._pending = self._pending, []
+
+            errors = {}
+            for request in batch:
+                if request.target not in errors:
+                    try:
+                        self._fsync(request.target)
+                        errors[request.target] = None
+                    except OSError as exception:
+                        logging.error(f"fsync of {request.target} failed: {exception}")
+                        errors[request.target] = exception
+                request.error = errors[request.target]
+
+            with self._condition:
+                for request in batch:
+                    request.done = True
+                self.batches += 1
+                self.synced += len(batch)
+                self._condition.notify_all()
+
+    def _fsync(self, target):
+        if isinstance(target, int):
+            os.fsync(target)
+        elif os.name == "posix":
+            # directories can't be opened for fsync on Windows, where renames are durable without it
+            dir_fd = os.open(target, os.O_RDONLY)
+            try:
+                os.fsync(dir_fd)
+            finally:
+                os.close(dir_fd)
@@ -0,0 +1,10 @@
+import peewee
+
+from Dependencies.RequestTracer import request_tracer
+
+
+class TracedSqliteDatabase(peewee.SqliteDatabase):
+    """SqliteDatabase that records every statement under the request's db_query stage."""
+    def execute_sql(self, sql, params=None, *args, **kwargs):
+        with request_tracer.span("db_query"):
+            return super().execute_sql(sql, params, *args, **kwargs)
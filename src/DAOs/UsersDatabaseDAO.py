@@ -1,10 +1,11 @@
 import logging
 import os
 import peewee
-from Dependencies.Constants import server_storage_path
+from DAOs.TracedSqliteDatabase import TracedSqliteDatabase
+from Dependencies.Constants import server_storage_path, sqlite_pragmas
 
 db_path = os.path.join(server_storage_path, "Users.db")
-users_db = peewee.SqliteDatabase(db_path)
+users_db = TracedSqliteDatabase(db_path, pragmas=sqlite_pragmas)
 os.makedirs(os.path.dirname(db_path), exist_ok=True)
 
 class UsersDB(peewee.Model):
@@ -34,6 +35,21 @@ class UsersDatabaseDAO:
         user_id = UsersDB.select().where(UsersDB.username == username).get().user_id
         return user_id
 
+    def get_password_hash(self, username):
+        """Returns None if there is no such user."""
+        user = UsersDB.select(UsersDB.password_hash).where(UsersDB.username == username).get_or_none()
+        return user.password_hash if user is not None else None
+
+    def update_password_hash(self, username, old_password_hash, new_password_hash):
+        """Only replaces old_password_hash, so concurrent upgrades of the same row don't overwrite each other."""
+        return UsersDB.update(password_hash=new_password_hash).where(
+            UsersDB.username == username,
+            UsersDB.password_hash == old_password_hash
+        ).execute() == 1
+
+    def get_users_after_id(self, user_id, limit):
+        return list(UsersDB.select().where(UsersDB.user_id > user_id).order_by(UsersDB.user_id).limit(limit))
+
     def check_username_against_password_hash(self, username, password):
         return UsersDB.select().where(UsersDB.username == username).get().password_hash == password
 
@@ -1,4 +1,7 @@
+import functools
 import os
+import pathlib
+
 import platformdirs
 
 # Constants:
@@ -17,24 +20,133 @@ end_flag = b"||| END |||"
 init_flag = b"(&) INIT (&)"
 resume_flag = b"(&) RESUME (&)"
 encryption_separator = b"(&) SEP (&)"
+busy_flag = b"(&) BUSY (&)"
+raw_public_key_length = 32  # X25519 public keys sent raw instead of PEM
 
 # Common Constants
-server_address = "0.0.0.0"
-server_port = 8081
+server_address = os.environ.get("CRYPTDRIVE_SERVER_ADDRESS", "0.0.0.0")
+server_port = int(os.environ.get("CRYPTDRIVE_SERVER_PORT", 8081))
 host_addr = (server_address, server_port)
 
 buffer_size = 1024
 
 # Server-Only Constants:
-server_storage_path = platformdirs.user_data_path(app_name)
+server_storage_path = pathlib.Path(os.environ["CRYPTDRIVE_STORAGE_PATH"]) if "CRYPTDRIVE_STORAGE_PATH" in os.environ else platformdirs.user_data_path(app_name)
+log_level = os.environ.get("CRYPTDRIVE_LOG_LEVEL", "DEBUG")
+
+# Multi-Process Mode (more than one worker process binds host_addr with SO_REUSEPORT)
+server_worker_processes = int(os.environ.get("CRYPTDRIVE_WORKERS", 1))
+worker_restart_backoff_seconds = 1  # doubled for each startup failure in a row
+max_worker_startup_failures = 5  # in a row, before the supervisor gives up
+supervisor_poll_seconds = 0.5  # how often the supervisor checks for exited workers between readiness reports
+
+# SQLite settings shared by both databases; WAL and a busy timeout let several worker processes use them at once
+sqlite_pragmas = {"journal_mode": "wal", "busy_timeout": 5000}
+
+# Blob Layout: <server_storage_path>/<owner_id>/<2 hex chars>/<2 hex chars>/<file_uuid>
+storage_shard_levels = 2
+storage_shard_width = 2
+storage_migration_checkpoint_path = os.path.join(server_storage_path, "storage_migration.json")
+
+# Upload Durability
+storage_temp_path = os.path.join(server_storage_path, ".tmp")  # must be on the same filesystem as the blobs
+stale_temp_file_seconds = 60 * 60
+fsync_batch_window_ms = 2  # uploads finishing within this window share one flush; 0 syncs every upload inline
+
+# Search
+search_default_page_size = 50
+search_max_page_size = 1000
+
+# Server-Side Copies
+copy_batch_size = 64  # blobs copied and synced together by COPY_DIR
+copy_chunk_size = 1024 * 1024  # used when neither reflinks nor copy_file_range work
+
+# Bulk Upload
+write_batch_size = 256  # blobs written and synced together, and rows inserted in one transaction, by BULK_UPLOAD
+bulk_upload_batch_bytes = 16 * 1024 * 1024  # a batch is also written once its files add up to this much
+
+# File Contents Cache (per worker process, for small files that are downloaded again and again)
+file_cache_max_bytes = 64 * 1024 * 1024
+file_cache_max_entry_bytes = 1024 * 1024
+
+# Storage Scrubber (reconciles blobs with FilesDB in the background, in one worker process)
+scrubber_enabled = True
+scrubber_interval_seconds = 6 * 60 * 60  # pause between the end of one pass and the start of the next
+scrubber_batch_size = 500
+scrubber_max_entries_per_second = 2000  # blobs and rows checked per second, keeps the scrubber's I/O in the background
+scrubber_orphan_grace_seconds = 10 * 60  # blobs younger than this may still be waiting for their row
+scrubber_verify_sizes = True
+scrubber_checkpoint_path = os.path.join(server_storage_path, "scrubber.json")
+scrubber_lock_path = os.path.join(server_storage_path, ".scrubber.lock")
+quarantine_path = os.path.join(server_storage_path, ".quarantine")  # orphan blobs are moved here, never deleted
+
+# Admin verbs are only accepted from these client addresses
+admin_addresses = ("127.0.0.1", "::1")
 
-# Server Keys
+# Connection Lifecycle
+receive_buffer_size = 64 * 1024
+socket_read_timeout_seconds = 10
+socket_write_timeout_seconds = 10
+max_request_duration_seconds = 300  # for the handshake and request frame; file contents have no overall limit
+min_throughput_bytes_per_second = 1024  # enforced once a frame has been arriving (or sending) for min_throughput_grace_seconds
+min_throughput_grace_seconds = 5
+# a frame is buffered whole before it is decrypted, and CREATE_FILE sends the whole file in one frame,
+# so this is also the largest file that can be uploaded
+max_frame_size = int(os.environ.get("CRYPTDRIVE_MAX_FRAME_SIZE", 512 * 1024 * 1024))
+
+# Admission Control
+max_queued_connections = 64  # accepted connections allowed to wait for a pool thread
+max_concurrent_requests_per_user = 4
+overload_retry_after_seconds = 1
+
+# Passwords: the client's password hash is stored as a salted scrypt hash, computed in a process pool
+password_hash_processes = 2
+max_pending_password_hashes = 16  # SIGN_UP/LOG_IN requests allowed to wait for the pool; more are turned away
+scrypt_n = 2 ** 14
+scrypt_r = 8
+scrypt_p = 1
+scrypt_salt_length = 16
+scrypt_hash_length = 32
+
+# Login Rate Limits (token buckets; SIGN_UP counts against the client IP as well)
+login_attempts_per_minute_per_user = int(os.environ.get("CRYPTDRIVE_LOGIN_ATTEMPTS_PER_MINUTE_PER_USER", 10))
+login_burst_per_user = int(os.environ.get("CRYPTDRIVE_LOGIN_BURST_PER_USER", 5))
+auth_attempts_per_minute_per_ip = int(os.environ.get("CRYPTDRIVE_AUTH_ATTEMPTS_PER_MINUTE_PER_IP", 60))
+auth_burst_per_ip = int(os.environ.get("CRYPTDRIVE_AUTH_BURST_PER_IP", 20))
+max_rate_limited_keys = 100_000
+
+# Number of pre-generated X25519 handshake keypairs
+ephemeral_key_pool_size = 64
+
+# Request Tracing
+slow_request_threshold_ms = 500
+slow_request_buffer_size = 100
+profiles_path = os.path.join(server_storage_path, "profiles")
+
+# Token Master Keys (wrap session keys into encryption tokens; sealed with the sealing key in the keyring file)
+master_keyring_sealing_key_path = os.environ.get("CRYPTDRIVE_SEALING_KEY")  # 32 random bytes, kept outside the source tree; unset keeps keys in memory
+master_keyring_path = os.path.join(server_storage_path, "master_keys.json")
+master_keyring_lock_path = os.path.join(server_storage_path, ".master_keys.lock")
+master_key_rotation_seconds = 24 * 60 * 60
+master_key_retention_seconds = master_key_rotation_seconds + 2 * 60 * 60  # outlives the 1-hour tokens of a retired key
+master_keyring_check_seconds = 60  # how often workers look for a rotation by another worker
+
+# Startup
+ready_file_path = os.path.join(server_storage_path, "server.ready")  # written once the server accepts connections
+
+# Server Keys (read on first use rather than on import)
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))  # directory in which this Constants.py file sits
 PUBLIC_KEY_PATH = os.path.join(BASE_DIR, "public.pem")
 PRIVATE_KEY_PATH = os.path.join(BASE_DIR, "private.pem")
 
-with open(PUBLIC_KEY_PATH, "r") as file:
-    public_key = file.read()
 
-with open(PRIVATE_KEY_PATH, "r") as file:
-    private_key = file.read()
+@functools.cache
+def get_public_key():
+    with open(PUBLIC_KEY_PATH, "r") as file:
+        return file.read()
+
+
+@functools.cache
+def get_private_key():
+    with open(PRIVATE_KEY_PATH, "r") as file:
+        return file.read()
@@ -0,0 +1,149 @@
+import cProfile
+import logging
+import os
+import random
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+from Dependencies.Constants import slow_request_threshold_ms, slow_request_buffer_size, profiles_path
+
+
+class RequestTrace:
+    def __init__(self, client_addr):
+        self.client_addr = client_addr
+        self.verb = None
+        self.started_at = time.time()
+        self.start = time.perf_counter()
+        self.stages = {}
+        self.span_stack = []  # [stage, start, time spent in child spans]
+        self.profiler = None
+
+
+class RequestTracer:
+    """
+    Request-scoped stage timing. Each pool thread handles one request at a time, so the current trace lives in a
+    thread local. Stage times are exclusive: time spent in a nested span is only counted for the inner stage.
+    Requests slower than slow_request_threshold_ms are kept with their stage breakdown in a ring buffer.
+    A fraction of requests, set at runtime with set_profile_sample_rate, opens a cProfile window that lasts from
+    the start of the sampled request to its end. cProfile records every thread of the process (on Python 3.12 it
+    hooks sys.monitoring), so the profile is of the whole process during that window: the sampled request plus
+    whatever the other handler threads did meanwhile. It is named after the sampled request's verb. Only the
+    newest slow_request_buffer_size profile files are kept under profiles_path; older ones are deleted.
+    """
+    def __init__(self):
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._profile_lock = threading.Lock()  # only one cProfile can be enabled in the process at a time
+        self.slow_request_threshold_ms = slow_request_threshold_ms
+        self.slow_requests = deque(maxlen=slow_request_buffer_size)
+        self.profile_sample_rate = 0.0
+        self.profiles = deque(maxlen=slow_request_buffer_size)
+
+    def start_request(self, client_addr):
+        trace = RequestTrace(client_addr)
+        if self.profile_sample_rate > 0 and random.random() < self.profile_sample_rate and self._profile_lock.acquire(blocking=False):
+            trace.profiler = cProfile.Profile()
+            trace.profiler.enable()
+        self._local.trace = trace
+
+    def set_verb(self, verb):
+        trace = getattr(self._local, "trace", None)
+        if trace is not None:
+            trace.verb = verb
+
+    @contextmanager
+    def span(self, stage):
+        trace = getattr(self._local, "trace", None)
+        if trace is None:
+            yield
+            return
+        frame = [stage, time.perf_counter(), 0.0]
+        trace.span_stack.append(frame)
+        try:
+            yield
+        finally:
+            trace.span_stack.pop()
+            elapsed = time.perf_counter() - frame[1]
+            trace.stages[stage] = trace.stages.get(stage, 0.0) + elapsed - frame[2]
+            if trace.span_stack:
+                trace.span_stack[-1][2] += elapsed
+
+    def finish_request(self):
+        trace = getattr(self._local, "trace", None)
+        if trace is None:
+            return
+        self._local.trace = None
+        total = time.perf_counter() - trace.start
+
+        profile_path = None
+        if trace.profiler is not None:
+            trace.profiler.disable()
+            profile_path = self._save_profile(trace)
+            self._profile_lock.release()
+
+        if total * 1000 >= self.slow_request_threshold_ms:
+            stages_ms = {stage: round(seconds * 1000, 3) for stage, seconds in trace.stages.items()}
+            stages_ms["other"] = round((total - sum(trace.stages.values())) * 1000, 3)
+            slow_request = {
+                "verb": trace.verb,
+                "client": f"{trace.client_addr[0]}:{trace.client_addr[1]}" if trace.client_addr else None,
+                "started_at": trace.started_at,
+                "total_ms": round(total * 1000, 3),
+                "stages_ms": stages_ms,
+                "profile": profile_path,
+            }
+            with self._lock:
+                self.slow_requests.append(slow_request)
+            logging.warning(f"Slow request: {slow_request}")
+
+    def set_profile_sample_rate(self, sample_rate):
+        self.profile_sample_rate = min(max(float(sample_rate), 0.0), 1.0)
+        logging.info(f"Profiling sample rate set to {self.profile_sample_rate}")
+
+    def get_slow_requests(self):
+        with self._lock:
+            return list(self.slow_requests)
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                "slow_request_threshold_ms": self.slow_request_threshold_ms,
+                "profile_sample_rate": self.profile_sample_rate,
+                "slow_requests": list(self.slow_requests),
+                "profiles": list(self.profiles),
+            }
+
+    def _save_profile(self, trace):
+        try:
+            os.makedirs(profiles_path, exist_ok=True)
+            profile_path = os.path.join(profiles_path, f"{time.strftime('%Y%m%d-%H%M%S')}-{trace.verb}-{time.time_ns()}.prof")
+            trace.profiler.dump_stats(profile_path)
+        except OSError as exception:
+            logging.error(f"Could not save request profile: {exception}")
+            return None
+        with self._lock:
+            self.profiles.append(profile_path)
+        logging.debug(f"Request profile saved to {profile_path}")
+        self._prune_profiles()
+        return profile_path
+
+    def _prune_profiles(self):
+        # keeps the newest slow_request_buffer_size files on disk, counting those of every worker process
+        try:
+            with os.scandir(profiles_path) as entries:
+                profiles = [(entry.stat().st_mtime_ns, entry.path) for entry in entries if entry.name.endswith(".prof")]
+        except OSError as exception:
+            logging.error(f"Could not list request profiles: {exception}")
+            return
+        for _, profile_path in sorted(profiles)[:-slow_request_buffer_size]:
+            try:
+                os.remove(profile_path)
+            except FileNotFoundError:  # pruned by another worker
+                pass
+            except OSError as exception:
+                logging.error(f"Could not remove old request profile {profile_path}: {exception}")
+
+
+request_tracer = RequestTracer()
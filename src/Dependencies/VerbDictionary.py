@@ -4,6 +4,7 @@ class Verbs(enum.Enum):
     SIGN_UP = "SIGN_UP" # [username, password_hash]
     LOG_IN = "LOG_IN" # [username, password_hash]
     CREATE_FILE = "CREATE_FILE" # [file_path, file_name] [file_contents]
+    BULK_UPLOAD = "BULK_UPLOAD" # [] [frames of entries: >HHQ path, name and contents lengths, path, name, contents; an empty frame ends the stream]
     CREATE_DIR = "CREATE_DIR" # [path, dir_name]
     DOWNLOAD_FILE = "DOWNLOAD_FILE" # [file_path, file_name]
     DELETE_FILE = "DELETE_FILE" # [file_path, file_name]
@@ -12,4 +13,9 @@ class Verbs(enum.Enum):
     RENAME_FILE = "RENAME_FILE" # [file_path, old_file_name, new_file_name]
     RENAME_DIR = "RENAME_DIR" # [path, old_dir_name, new_dir_name]
     MOVE_FILE = "MOVE_FILE" # [old_file_path, new_file_path, file_name]
-    MOVE_DIR = "MOVE_DIR" # [old_dir_path, new_dir_path, dir_name]
\ No newline at end of file
+    MOVE_DIR = "MOVE_DIR" # [old_dir_path, new_dir_path, dir_name]
+    COPY_FILE = "COPY_FILE" # [file_path, file_name, new_file_path, new_file_name]
+    COPY_DIR = "COPY_DIR" # [path, dir_name, new_path, new_dir_name]
+    SEARCH = "SEARCH" # [query, match ("substring" | "prefix"), item_type ("any" | "file" | "dir"), min_size, max_size, cursor, page_size]
+    ADMIN_GET_STATS = "ADMIN_GET_STATS" # []
+    ADMIN_SET_PROFILING = "ADMIN_SET_PROFILING" # [sample_rate]
\ No newline at end of file
@@ -0,0 +1,126 @@
+import logging
+import math
+import threading
+import time
+
+from Dependencies.Constants import max_queued_connections, max_concurrent_requests_per_user, max_rate_limited_keys
+
+
+class AdmissionController:
+    """
+    Bounds the number of accepted connections that are running or waiting for a pool thread.
+    Connections beyond worker_count + queue_depth are rejected right away instead of queueing
+    in the executor until the client times out.
+    """
+    def __init__(self, worker_count, queue_depth=max_queued_connections):
+        self.capacity = worker_count + queue_depth
+        self._slots = threading.BoundedSemaphore(self.capacity)
+        self._lock = threading.Lock()
+        self.in_flight = 0
+        self.admitted = 0
+        self.rejected = 0
+
+    def try_admit(self):
+        if self._slots.acquire(blocking=False):
+            with self._lock:
+                self.in_flight += 1
+                self.admitted += 1
+            return True
+        with self._lock:
+            self.rejected += 1
+        logging.warning(f"Connection rejected: {self.capacity} connections already admitted.")
+        return False
+
+    def release(self):
+        with self._lock:
+            self.in_flight -= 1
+        self._slots.release()
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                "capacity": self.capacity,
+                "in_flight": self.in_flight,
+                "admitted": self.admitted,
+                "rejected": self.rejected,
+            }
+
+
+class UserConcurrencyLimiter:
+    """Caps the requests a single user may have in flight, so one user's bulk transfer can't occupy every pool thread."""
+    def __init__(self, max_per_user=max_concurrent_requests_per_user):
+        self.max_per_user = max_per_user
+        self._lock = threading.Lock()
+        self._active = {}
+        self.rejected = 0
+
+    def try_acquire(self, username):
+        with self._lock:
+            active = self._active.get(username, 0)
+            if active >= self.max_per_user:
+                self.rejected += 1
+                logging.warning(f"Request rejected: {username} already has {active} requests in flight.")
+                return False
+            self._active[username] = active + 1
+            return True
+
+    def release(self, username):
+        with self._lock:
+            active = self._active[username] - 1
+            if active > 0:
+                self._active[username] = active
+            else:
+                del self._active[username]
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                "max_per_user": self.max_per_user,
+                "active_users": len(self._active),
+                "rejected": self.rejected,
+            }
+
+
+class KeyedRateLimiter:
+    """
+    Token bucket per key (a username or a client IP): bursts of up to burst attempts, refilled at rate_per_minute.
+    Buckets that have refilled completely carry no information and are dropped once max_keys buckets are tracked.
+    """
+    def __init__(self, rate_per_minute, burst, max_keys=max_rate_limited_keys):
+        self.rate = rate_per_minute / 60
+        self.burst = burst
+        self.max_keys = max_keys
+        self._lock = threading.Lock()
+        self._buckets = {}  # key -> (tokens, monotonic time of the last update)
+        self.allowed = 0
+        self.limited = 0
+
+    def try_acquire(self, key):
+        """Returns 0 if the attempt may go ahead, else the seconds until it would be allowed."""
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated_at = self._buckets.get(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated_at) * self.rate)
+            if tokens < 1:
+                self._buckets[key] = (tokens, now)
+                self.limited += 1
+                return math.ceil((1 - tokens) / self.rate)
+            if key not in self._buckets and len(self._buckets) >= self.max_keys:
+                self._drop_full_buckets(now)
+            self._buckets[key] = (tokens - 1, now)
+            self.allowed += 1
+            return 0
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                "rate_per_minute": self.rate * 60,
+                "burst": self.burst,
+                "tracked_keys": len(self._buckets),
+                "allowed": self.allowed,
+                "limited": self.limited,
+            }
+
+    def _drop_full_buckets(self, now):
+        self._buckets = {key: (tokens, updated_at) for key, (tokens, updated_at) in self._buckets.items()
+                         if tokens + (now - updated_at) * self.rate < self.burst}
@@ -0,0 +1,149 @@
+import logging
+import socket
+import threading
+import time
+
+from Dependencies.Constants import socket_read_timeout_seconds, socket_write_timeout_seconds, \
+    max_request_duration_seconds, min_throughput_bytes_per_second, min_throughput_grace_seconds
+
+socket_max_buffers_per_send = 64  # well below IOV_MAX on every platform
+
+
+class ConnectionTerminated(Exception):
+    """Raised when a connection is torn down before its request finished. reason is the counted outcome."""
+    def __init__(self, reason, message):
+        super().__init__(message)
+        self.reason = reason
+
+
+class ConnectionLifecycle:
+    """
+    Wraps a client socket with read and write deadlines, a maximum duration for the handshake and request frame,
+    and a minimum-throughput rule for every frame received or sent after that.
+    Every way a connection can stall ends in a ConnectionTerminated, so the pool thread serving it is released.
+    """
+    def __init__(self, client: socket.socket):
+        self.client = client
+        self.request_deadline = time.monotonic() + max_request_duration_seconds  # None once the request has arrived
+        self.frame_started_at = None  # of the current frame, or of the whole stream after start_stream
+        self.frame_bytes_received = 0
+        self.is_streaming = False
+
+    def end_request_deadline(self):
+        """
+        Called once the handshake and request frame have arrived. File contents sent or received after that take as
+        long as the link needs, so only the read and write deadlines and the minimum throughput end a stalled transfer.
+        """
+        self.request_deadline = None
+
+    def start_stream(self):
+        """
+        For verbs that stream many frames, like BULK_UPLOAD: from now on the minimum throughput applies to the whole
+        stream rather than to each frame, so a client can't keep the connection by trickling small frames.
+        """
+        self.is_streaming = True
+        self.frame_started_at = time.monotonic()
+        self.frame_bytes_received = 0
+
+    def start_frame(self):
+        if self.is_streaming:
+            return
+        self.frame_started_at = time.monotonic()
+        self.frame_bytes_received = 0
+
+    def recv(self, size):
+        now = time.monotonic()
+        self._check_request_deadline(now)
+        self._check_throughput(now - self.frame_started_at, self.frame_bytes_received, "sent")
+
+        self.client.settimeout(self._timeout(socket_read_timeout_seconds, now))
+        try:
+            data_chunk = self.client.recv(size)
+        except socket.timeout:
+            raise ConnectionTerminated("read_timeout", "Client sent nothing before the read deadline")
+        except ConnectionError as exception:
+            raise ConnectionTerminated("reset", f"Connection reset while receiving: {exception}")
+
+        if not data_chunk:
+            raise ConnectionTerminated("peer_closed", "Client closed the connection mid-request")
+        self.frame_bytes_received += len(data_chunk)
+        return data_chunk
+
+    def sendall(self, data):
+        now = time.monotonic()
+        self._check_request_deadline(now)
+        self.client.settimeout(self._timeout(socket_write_timeout_seconds, now))
+        try:
+            self.client.sendall(data)
+        except socket.timeout:
+            raise ConnectionTerminated("write_timeout", "Client did not read the response before the write deadline")
+        except ConnectionError as exception:
+            raise ConnectionTerminated("reset", f"Connection reset while sending: {exception}")
+
+    def sendmsg(self, buffers):
+        """
+        Sends the buffers as one frame with scatter-gather sendmsg calls, without joining them.
+        The write deadline applies to each call and the minimum throughput to the whole frame, so a large response
+        only fails if the client stops reading or reads it more slowly than min_throughput_bytes_per_second.
+        """
+        if not hasattr(self.client, "sendmsg"):
+            # e.g. Windows
+            return self.sendall(b"".join(buffers))
+
+        buffers = [memoryview(buffer) for buffer in buffers if len(buffer) > 0]
+        started_at = time.monotonic()
+        bytes_sent = 0
+        try:
+            while buffers:
+                now = time.monotonic()
+                self._check_request_deadline(now)
+                self._check_throughput(now - started_at, bytes_sent, "read")
+                self.client.settimeout(self._timeout(socket_write_timeout_seconds, now))
+                sent = self.client.sendmsg(buffers[:socket_max_buffers_per_send])
+                bytes_sent += sent
+                while sent > 0:
+                    if sent >= len(buffers[0]):
+                        sent -= len(buffers.pop(0))
+                    else:
+                        buffers[0] = buffers[0][sent:]
+                        sent = 0
+        except socket.timeout:
+            raise ConnectionTerminated("write_timeout", "Client did not read the response before the write deadline")
+        except ConnectionError as exception:
+            raise ConnectionTerminated("reset", f"Connection reset while sending: {exception}")
+
+    def _timeout(self, socket_timeout_seconds, now):
+        if self.request_deadline is None:
+            return socket_timeout_seconds
+        return min(socket_timeout_seconds, self.request_deadline - now)
+
+    def _check_request_deadline(self, now):
+        if self.request_deadline is not None and now >= self.request_deadline:
+            raise ConnectionTerminated("request_deadline", f"Request exceeded {max_request_duration_seconds}s")
+
+    def _check_throughput(self, elapsed, bytes_transferred, direction):
+        if elapsed > min_throughput_grace_seconds and bytes_transferred / elapsed < min_throughput_bytes_per_second:
+            raise ConnectionTerminated("too_slow", f"Client {direction} {bytes_transferred} bytes in {elapsed:.1f}s")
+
+
+class ConnectionLifecycleManager:
+    """Hands out a ConnectionLifecycle per accepted client and counts how each connection ended."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.outcomes = {}
+
+    def track(self, client: socket.socket) -> ConnectionLifecycle:
+        return ConnectionLifecycle(client)
+
+    def record_outcome(self, outcome):
+        with self._lock:
+            self.outcomes[outcome] = self.outcomes.get(outcome, 0) + 1
+        if outcome != "completed":
+            logging.info(f"Connection ended early: {outcome}")
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                "outcomes": dict(self.outcomes),
+                "reclaimed": sum(count for outcome, count in self.outcomes.items() if outcome != "completed"),
+            }
@@ -0,0 +1,66 @@
+import logging
+import queue
+import threading
+
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import x25519
+
+from Dependencies.Constants import ephemeral_key_pool_size
+
+
+class EphemeralKey:
+    __slots__ = ("private_key", "public_key_pem", "public_key_raw")
+
+    def __init__(self, private_key: x25519.X25519PrivateKey):
+        self.private_key = private_key
+        public_key = private_key.public_key()
+        self.public_key_pem = public_key.public_bytes(serialization.Encoding.PEM, serialization.PublicFormat.SubjectPublicKeyInfo)
+        self.public_key_raw = public_key.public_bytes(serialization.Encoding.Raw, serialization.PublicFormat.Raw)
+
+
+class EphemeralKeyPool:
+    """
+    Keeps a pool of single-use X25519 keypairs, with both public key encodings already serialized,
+    filled by a background producer thread so handshakes don't generate keys on the request thread.
+    Every key is handed out exactly once; if the pool runs dry a key is generated inline.
+    """
+    def __init__(self, pool_size=ephemeral_key_pool_size):
+        self._keys = queue.Queue(maxsize=pool_size)
+        self._lock = threading.Lock()  # guards the counters, which many handler threads update
+        self.hits = 0
+        self.misses = 0
+        if pool_size > 0:
+            threading.Thread(target=self._produce, name="EphemeralKeyPool", daemon=True).start()
+
+    def get_key(self) -> EphemeralKey:
+        try:
+            key = self._keys.get_nowait()
+            with self._lock:
+                self.hits += 1
+        except queue.Empty:
+            logging.debug("Ephemeral key pool is empty. Generating key inline...")
+            key = EphemeralKey(x25519.X25519PrivateKey.generate())
+            with self._lock:
+                self.misses += 1
+        return key
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                "available": self._keys.qsize(),
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+    def _produce(self):
+        while True:
+            # blocks while the pool is full
+            self._keys.put(EphemeralKey(x25519.X25519PrivateKey.generate()))
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.DEBUG)
+
+    pool = EphemeralKeyPool(8)
+    key = pool.get_key()
+    print(key.public_key_pem, key.public_key_raw, pool.get_stats())
@@ -0,0 +1,71 @@
+import threading
+from collections import OrderedDict
+
+from Dependencies.Constants import file_cache_max_bytes, file_cache_max_entry_bytes
+
+
+class FileContentsCache:
+    """
+    LRU cache of blob contents keyed by (file_owner_id, file_uuid), bounded by the total size of the cached contents.
+    Blobs are never modified in place and a uuid is never reused, so the only invalidation needed is on delete.
+    Every worker process has its own cache; an entry left behind by a delete in another worker can't be served,
+    since downloads look the uuid up in FilesDB first, and it is evicted like any other cold entry.
+    """
+    def __init__(self, max_bytes=file_cache_max_bytes, max_entry_bytes=file_cache_max_entry_bytes):
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = min(max_entry_bytes, max_bytes)
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self.size_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, file_owner_id, file_uuid):
+        key = (file_owner_id, file_uuid)
+        with self._lock:
+            file_contents = self._entries.get(key)
+            if file_contents is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return file_contents
+
+    def put(self, file_owner_id, file_uuid, file_contents):
+        if len(file_contents) > self.max_entry_bytes:
+            return
+        key = (file_owner_id, file_uuid)
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return
+            self._entries[key] = file_contents
+            self.size_bytes += len(file_contents)
+            while self.size_bytes > self.max_bytes:
+                _, evicted_contents = self._entries.popitem(last=False)
+                self.size_bytes -= len(evicted_contents)
+                self.evictions += 1
+
+    def invalidate(self, file_owner_id, file_uuid):
+        with self._lock:
+            file_contents = self._entries.pop((file_owner_id, file_uuid), None)
+            if file_contents is not None:
+                self.size_bytes -= len(file_contents)
+                self.invalidations += 1
+
+    def get_stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "size_bytes": self.size_bytes,
+                "max_bytes": self.max_bytes,
+                "max_entry_bytes": self.max_entry_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+            }
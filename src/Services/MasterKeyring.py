@@ -0,0 +1,176 @@
+import json
+import logging
+import os
+import threading
+import time
+from base64 import b64encode, b64decode
+from contextlib import contextmanager
+
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+from Dependencies.Constants import master_keyring_path, master_keyring_lock_path, master_keyring_sealing_key_path, \
+    master_key_rotation_seconds, master_key_retention_seconds, master_keyring_check_seconds
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+
+class MasterKeyring:
+    """
+    The master keys that wrap session keys into encryption tokens, persisted in master_keyring_path so that
+    resume tokens survive restarts and are accepted by every worker process. Keys are sealed (AES-GCM) with the
+    256-bit sealing key in the file CRYPTDRIVE_SEALING_KEY names, kept outside the source tree, so the keyring
+    file alone reveals nothing. Without a sealing key nothing is persisted: a single key lives as long as the
+    process (or the supervisor that forked it), and tokens don't survive a restart.
+    Every token names the key that wrapped it (kid). The active key is replaced every master_key_rotation_seconds;
+    retired keys are kept for master_key_retention_seconds so tokens minted before a rotation still resume.
+    Worker processes share the file: rotation happens under an flock, and the others pick up the new file when
+    they next check it or when a token names a key they haven't loaded yet.
+    """
+    def __init__(self, path=master_keyring_path, lock_path=master_keyring_lock_path, sealing_key_path=master_keyring_sealing_key_path):
+        self.path = path
+        self.lock_path = lock_path
+        self._sealing_aesgcm = self._load_sealing_key(sealing_key_path) if sealing_key_path else None
+        self.is_persistent = self._sealing_aesgcm is not None
+        self._lock = threading.Lock()
+        self._keys = {}  # kid -> (created_at, key, AESGCM)
+        self.active_kid = None
+        self._loaded_mtime = None
+        self._next_check = 0.0
+        self.rotations = 0
+        self.reloads = 0
+        if not self.is_persistent:
+            logging.warning("CRYPTDRIVE_SEALING_KEY is not set. Token master keys are kept in memory only; "
+                            "clients will need a new handshake after every restart.")
+            self._rotate()
+            return
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with self._file_lock():
+            self._load()
+            if self._active_key_is_due():
+                self._rotate()
+        self._next_check = time.monotonic() + master_keyring_check_seconds
+
+    def seal(self, session_key):
+        """Returns (kid, nonce, encrypted session key)."""
+        if self.is_persistent and time.monotonic() >= self._next_check:
+            self._check_for_rotation()
+        with self._lock:
+            kid = self.active_kid
+            aesgcm = self._keys[kid][2]
+        nonce = os.urandom(12)
+        return kid, nonce, aesgcm.encrypt(nonce, session_key, None)
+
+    def unseal(self, kid, nonce, encrypted_key):
+        """Raises KeyError for a key that has been retired or never existed, InvalidTag for a tampered token."""
+        with self._lock:
+            key = self._keys.get(kid)
+        if key is None:
+            # possibly rotated in by another worker process since we last looked
+            with self._lock:
+                self._reload_if_changed()
+                key = self._keys[kid]
+        return key[2].decrypt(nonce, encrypted_key, None)
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                "active_kid": self.active_kid,
+                "active_key_age_seconds": int(time.time() - self._keys[self.active_kid][0]),
+                "persistent": self.is_persistent,
+                "keys": len(self._keys),
+                "rotations": self.rotations,
+                "reloads": self.reloads,
+            }
+
+    def _check_for_rotation(self):
+        with self._lock:
+            self._next_check = time.monotonic() + master_keyring_check_seconds
+            self._reload_if_changed()
+            if not self._active_key_is_due():
+                return
+        with self._file_lock(), self._lock:
+            # another worker may have rotated while we waited for the file lock
+            self._load()
+            if self._active_key_is_due():
+                self._rotate()
+
+    def _active_key_is_due(self):
+        return self.active_kid is None or time.time() - self._keys[self.active_kid][0] >= master_key_rotation_seconds
+
+    def _rotate(self):
+        oldest = time.time() - master_key_retention_seconds
+        self._keys = {kid: entry for kid, entry in self._keys.items() if entry[0] >= oldest}
+        kid = os.urandom(8).hex()
+        key = AESGCM.generate_key(bit_length=256)
+        self._keys[kid] = (time.time(), key, AESGCM(key))
+        if self.is_persistent:
+            self._save(kid)
+        self.active_kid = kid
+        self.rotations += 1
+        logging.info(f"Rotated the token master key. Active key: {kid}.")
+
+    def _reload_if_changed(self):
+        if not self.is_persistent:
+            return
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            return
+        if mtime != self._loaded_mtime:
+            self._load()
+            self.reloads += 1
+
+    def _load(self):
+        try:
+            with open(self.path) as file:
+                self._loaded_mtime = os.fstat(file.fileno()).st_mtime_ns
+                keyring = json.load(file)
+        except FileNotFoundError:
+            return
+        oldest = time.time() - master_key_retention_seconds
+        keys = {}
+        for entry in keyring["keys"]:
+            if entry["created_at"] >= oldest or entry["kid"] == keyring["active_kid"]:
+                sealed_key = b64decode(entry["sealed_key"])
+                try:
+                    key = self._sealing_aesgcm.decrypt(sealed_key[:12], sealed_key[12:], entry["kid"].encode())
+                except InvalidTag:
+                    logging.error(f"Token master key {entry['kid']} was sealed with another sealing key. Ignoring it.")
+                    continue
+                keys[entry["kid"]] = (entry["created_at"], key, AESGCM(key))
+        self._keys = keys
+        self.active_kid = keyring["active_kid"] if keyring["active_kid"] in keys else None
+
+    def _save(self, active_kid):
+        entries = []
+        for kid, (created_at, key, _) in self._keys.items():
+            nonce = os.urandom(12)
+            sealed_key = nonce + self._sealing_aesgcm.encrypt(nonce, key, kid.encode())  # the kid is authenticated too
+            entries.append({"kid": kid, "created_at": created_at, "sealed_key": b64encode(sealed_key).decode()})
+        temp_path = f"{self.path}.{os.getpid()}.tmp"
+        with os.fdopen(os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "w") as file:
+            json.dump({"active_kid": active_kid, "keys": entries}, file)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_path, self.path)
+        self._loaded_mtime = os.stat(self.path).st_mtime_ns
+
+    def _load_sealing_key(self, sealing_key_path):
+        with open(sealing_key_path, "rb") as file:
+            sealing_key = file.read()
+        if len(sealing_key) != 32:
+            raise ValueError(f"The sealing key in {sealing_key_path} must be 32 random bytes, e.g. from head -c 32 /dev/urandom.")
+        return AESGCM(sealing_key)
+
+    @contextmanager
+    def _file_lock(self):
+        if fcntl is None:
+            yield
+            return
+        with open(self.lock_path, "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            yield
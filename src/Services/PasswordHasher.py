@@ -0,0 +1,92 @@
+import base64
+import hashlib
+import hmac
+import logging
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+from Dependencies.Constants import password_hash_processes, max_pending_password_hashes, scrypt_n, scrypt_r, scrypt_p, \
+    scrypt_salt_length, scrypt_hash_length
+from Dependencies.RequestTracer import request_tracer
+
+hash_scheme = "scrypt"
+
+
+class PasswordHasherBusy(Exception):
+    pass
+
+
+class PasswordHasher:
+    """
+    Salted scrypt hashing of the password hash the client sends, stored as scrypt$n$r$p$<salt>$<hash> (base64).
+    scrypt runs in a small process pool, so a burst of logins neither holds the GIL nor pins more than
+    max_pending_password_hashes worker threads; further logins are turned away with PasswordHasherBusy.
+    """
+    def __init__(self, processes=password_hash_processes, max_pending=max_pending_password_hashes):
+        # forkserver: forking the multithreaded server itself could copy locks held by other threads
+        start_method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+        self.pool = ProcessPoolExecutor(processes, mp_context=multiprocessing.get_context(start_method))
+        self._pending = threading.BoundedSemaphore(max_pending)
+        self._lock = threading.Lock()
+        self.hashed = 0
+        self.verified = 0
+        self.rejected = 0
+        # verified instead of a stored hash when there is none, so that unknown usernames take as long as known ones
+        self.dummy_hash = "$".join((hash_scheme, str(scrypt_n), str(scrypt_r), str(scrypt_p),
+                                    base64.b64encode(bytes(scrypt_salt_length)).decode(), base64.b64encode(bytes(scrypt_hash_length)).decode()))
+
+    def warm_up(self):
+        """Starts the pool processes in the background, so the first login doesn't wait for them."""
+        self.pool.submit(hashlib.scrypt, b"", salt=b"", n=2, r=1, p=1)
+
+    def hash_password(self, password):
+        salt = os.urandom(scrypt_salt_length)
+        derived_key = self._scrypt(password, salt, scrypt_n, scrypt_r, scrypt_p)
+        with self._lock:
+            self.hashed += 1
+        return "$".join((hash_scheme, str(scrypt_n), str(scrypt_r), str(scrypt_p),
+                         base64.b64encode(salt).decode(), base64.b64encode(derived_key).decode()))
+
+    def verify_password(self, password, stored_hash):
+        scheme, n, r, p, salt, expected_key = stored_hash.split("$")
+        if scheme != hash_scheme:
+            raise ValueError(f"Unknown password hash scheme {scheme}.")
+        expected_key = base64.b64decode(expected_key)
+        derived_key = self._scrypt(password, base64.b64decode(salt), int(n), int(r), int(p), len(expected_key))
+        with self._lock:
+            self.verified += 1
+        return hmac.compare_digest(derived_key, expected_key)
+
+    def close(self):
+        """Stops the pool processes; logins still waiting for a hash fail."""
+        self.pool.shutdown(cancel_futures=True)
+
+    def is_hashed(self, stored_hash):
+        """False for rows stored before server-side hashing, which hold the client's hash as is."""
+        return stored_hash.startswith(hash_scheme + "$")
+
+    def needs_rehash(self, stored_hash):
+        return not self.is_hashed(stored_hash) or stored_hash.split("$")[1:4] != [str(scrypt_n), str(scrypt_r), str(scrypt_p)]
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                "hashed": self.hashed,
+                "verified": self.verified,
+                "rejected_busy": self.rejected,
+            }
+
+    def _scrypt(self, password, salt, n, r, p, length=scrypt_hash_length):
+        if not self._pending.acquire(blocking=False):
+            with self._lock:
+                self.rejected += 1
+            logging.warning(f"Password hashing rejected: {max_pending_password_hashes} hashes already pending.")
+            raise PasswordHasherBusy()
+        try:
+            with request_tracer.span("password_hash"):
+                return self.pool.submit(hashlib.scrypt, password.encode(), salt=salt, n=n, r=r, p=p,
+                                        maxmem=256 * n * r + 1024 * 1024, dklen=length).result()
+        finally:
+            self._pending.release()
@@ -0,0 +1,45 @@
+import argparse
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from DAOs.UsersDatabaseDAO import UsersDatabaseDAO
+from Dependencies.Constants import password_hash_processes
+from Services.PasswordHasher import PasswordHasher
+
+
+class PasswordMigrationService:
+    """
+    Replaces the password hashes stored before server-side hashing with their scrypt hash. The stored value is
+    exactly what the client sends at login, so rows can be migrated without the users; UsersService.login
+    verifies scrypt(client hash) from then on. Rows are only updated if they still hold the old value, so it is
+    safe to run while the server is up (login upgrades rows too), and to rerun after an interruption.
+    """
+    def __init__(self, users_database_dao: UsersDatabaseDAO, password_hasher: PasswordHasher):
+        self.users_database_dao = users_database_dao
+        self.password_hasher = password_hasher
+
+    def migrate(self, batch_size=100):
+        migrated = 0
+        last_user_id = 0
+        with ThreadPoolExecutor(password_hash_processes) as threads:
+            while users := self.users_database_dao.get_users_after_id(last_user_id, batch_size):
+                legacy_users = [user for user in users if not self.password_hasher.is_hashed(user.password_hash)]
+                migrated += sum(threads.map(self._migrate_user, legacy_users))
+                last_user_id = users[-1].user_id
+                logging.info(f"Checked users up to id {last_user_id}, {migrated} migrated so far.")
+        logging.info(f"Migration finished. {migrated} password hashes migrated.")
+        return migrated
+
+    def _migrate_user(self, user):
+        new_password_hash = self.password_hasher.hash_password(user.password_hash)
+        return self.users_database_dao.update_password_hash(user.username, user.password_hash, new_password_hash)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description="Hashes password hashes stored before server-side hashing with scrypt. Safe to run while the server is up.")
+    parser.add_argument("--batch-size", type=int, default=100)
+    args = parser.parse_args()
+
+    PasswordMigrationService(UsersDatabaseDAO(), PasswordHasher()).migrate(batch_size=args.batch_size)
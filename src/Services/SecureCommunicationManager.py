@@ -1,47 +1,55 @@
 import logging
-import socket
-import sys
-import time
 from base64 import b64decode
 from os import urandom
 
 from cryptography import exceptions
 from cryptography.hazmat.primitives import hashes, serialization
 from cryptography.hazmat.primitives.asymmetric import x25519
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
 from cryptography.hazmat.primitives.ciphers.aead import AESGCM
 from cryptography.hazmat.primitives.kdf.hkdf import HKDF
 
 from Dependencies import Constants
-from Dependencies.Constants import buffer_size, end_flag, encryption_separator, resume_flag, init_flag
+from Dependencies.Constants import receive_buffer_size, end_flag, encryption_separator, resume_flag, init_flag, \
+    raw_public_key_length, max_frame_size
+from Dependencies.RequestTracer import request_tracer
+from Services.ConnectionLifecycleManager import ConnectionLifecycle, ConnectionTerminated
+from Services.EphemeralKeyPool import EphemeralKeyPool
+from Services.MasterKeyring import MasterKeyring
 from Services.TokenService import TokenService
 
+gcm_block_size = 16
+gcm_tag_size = 16
+
 
 class SecureCommunicationManager:
-    def __init__(self, client: socket.socket, token_service: TokenService, master_key):
-        self.client: socket.socket = client
+    def __init__(self, connection: ConnectionLifecycle, token_service: TokenService, keyring: MasterKeyring, key_pool: EphemeralKeyPool):
+        self.connection: ConnectionLifecycle = connection
         self.token_service = token_service
-        self.master_aesgcm: AESGCM = AESGCM(master_key)
+        self.key_pool = key_pool
+        self.keyring = keyring
         self.key = None
         self.aesgcm = None
         self.token = b""
+        self.received_data = bytearray()
+        self.send_buffer = bytearray()  # reused for every response on this connection
 
     def receive_data(self):
         logging.debug("Initializing data receiving")
-        received_data = b""
-        counter = 0
-        finished = False
-        while not finished:
-            data_chunk = self.client.recv(buffer_size)
-            counter += 1
-            if len(data_chunk) > 0 :logging.debug(f"Received data chunk ({len(data_chunk)}): {data_chunk[:10]}...{data_chunk[-10:]}")
-            else:
-                sys.stdout.write(".")
-                time.sleep(1)
-            received_data += data_chunk
-            if received_data.endswith(end_flag) or (len(data_chunk) < buffer_size and len(received_data) > 0):
-                received_data = received_data[:-len(end_flag)]
-                finished = True
-            if counter == 2: logging.debug(f"Received data: {received_data}")
+        with request_tracer.span("receive_data"):
+            self.connection.start_frame()
+            frame_end = self.received_data.find(end_flag)
+            while frame_end == -1:
+                searched_up_to = max(len(self.received_data) - len(end_flag) + 1, 0)
+                if searched_up_to > max_frame_size:
+                    raise ConnectionTerminated("frame_too_large", f"Client sent a frame larger than {max_frame_size} bytes")
+                data_chunk = self.connection.recv(receive_buffer_size)
+                logging.debug(f"Received data chunk ({len(data_chunk)}): {data_chunk[:10]}...{data_chunk[-10:]}")
+                self.received_data += data_chunk
+                frame_end = self.received_data.find(end_flag, searched_up_to)
+        # bytes after the end flag belong to the next frame, which a streaming client may already have sent
+        received_data = bytes(self.received_data[:frame_end])
+        del self.received_data[:frame_end + len(end_flag)]
         logging.debug(f"finished receiving data: {received_data[:25]}...{received_data[-25:]}")
 
         data_parts = received_data.split(encryption_separator)
@@ -50,26 +58,30 @@ class SecureCommunicationManager:
         match flag:
             case Constants.init_flag:
                 logging.info("Starting encryption handshake")
-                private_key = x25519.X25519PrivateKey.generate()
-                public_key = private_key.public_key()
+                with request_tracer.span("handshake"):
+                    ephemeral_key = self.key_pool.get_key()
 
-                client_public_key_bytes = encrypted_message
-                client_public_key = serialization.load_pem_public_key(client_public_key_bytes)
-                logging.debug(f"Client public key: {client_public_key_bytes}")
+                    client_public_key_bytes = encrypted_message
+                    # Clients may send the raw 32-byte public key instead of PEM; we answer in the same encoding.
+                    is_raw_key = len(client_public_key_bytes) == raw_public_key_length
+                    if is_raw_key:
+                        client_public_key = x25519.X25519PublicKey.from_public_bytes(client_public_key_bytes)
+                    else:
+                        client_public_key = serialization.load_pem_public_key(client_public_key_bytes)
+                    logging.debug(f"Client public key: {client_public_key_bytes}")
 
-                shared_secret = private_key.exchange(client_public_key)
+                    shared_secret = ephemeral_key.private_key.exchange(client_public_key)
 
-                self.key = HKDF(algorithm=hashes.SHA256(), length=32, salt=None, info=b"encryption key").derive(shared_secret)
-                self.aesgcm = AESGCM(self.key)
+                    self.key = HKDF(algorithm=hashes.SHA256(), length=32, salt=None, info=b"encryption key").derive(shared_secret)
+                    self.aesgcm = AESGCM(self.key)
 
-                public_key_bytes = public_key.public_bytes(serialization.Encoding.PEM, serialization.PublicFormat.SubjectPublicKeyInfo)
+                    public_key_bytes = ephemeral_key.public_key_raw if is_raw_key else ephemeral_key.public_key_pem
 
-                token_key_nonce = urandom(12)
-                encrypted_key = self.master_aesgcm.encrypt(token_key_nonce, self.key, None)
-                self.token = self.token_service.create_encryption_token(encrypted_key=encrypted_key, nonce=token_key_nonce)
+                self.token = self._create_encryption_token()
                 message = self._write_non_encrypted_data(message=public_key_bytes, token=self.token, encryption_flag=init_flag)
                 logging.debug(f"Sending message: {message}")
-                self.client.sendall(message)
+                with request_tracer.span("send"):
+                    self.connection.sendall(message)
                 return self.receive_data()
 
             case Constants.resume_flag:
@@ -80,33 +92,64 @@ class SecureCommunicationManager:
                     logging.debug(f"Encrypted key: {encrypted_key}, type: {type(encrypted_key)},\nkey nonce: {key_nonce}, type: {type(key_nonce)}")
 
                     try:
-                        self.key = self.master_aesgcm.decrypt(key_nonce, encrypted_key, None)
-                    except exceptions.InvalidTag:
+                        with request_tracer.span("aes_gcm"):
+                            self.key = self.keyring.unseal(decoded_token.get("kid"), key_nonce, encrypted_key)
+                    except (exceptions.InvalidTag, KeyError):
+                        # tampered, or wrapped by a master key that has been retired
                         logging.error("Invalid token key")
-                        self.client.sendall(self._write_encrypted_data(message=b"", token=b"", encryption_flag=init_flag))
+                        self.connection.sendall(self._write_encrypted_data(message=b"", token=b"", encryption_flag=init_flag))
                         return self.receive_data()
 
-                    self.aesgcm = AESGCM(self.key)
-                    decrypted_message = self.aesgcm.decrypt(nonce, encrypted_message, None)
+                    with request_tracer.span("aes_gcm"):
+                        self.aesgcm = AESGCM(self.key)
+                        decrypted_message = self.aesgcm.decrypt(nonce, encrypted_message, None)
                     logging.debug(f"Decrypted message: {decrypted_message}")
                     return decrypted_message
                 else:
                     logging.error("Invalid token. Sending initialization flag...")
-                    self.client.sendall(self._write_encrypted_data(message=b"", token=b"", encryption_flag=init_flag))
+                    self.connection.sendall(self._write_encrypted_data(message=b"", token=b"", encryption_flag=init_flag))
                     return self.receive_data()
             case _:
                 logging.error("Invalid flag received")
                 return "ERROR"
 
-    def respond_to_client(self, message: bytes):
+    def respond_to_client(self, *message_parts: bytes):
+        """
+        Encrypts the message parts, in order, as one message and sends the frame with scatter-gather I/O.
+        The parts are encrypted straight into the connection's send buffer, so the message is never joined
+        and the ciphertext is never copied into a frame before it reaches the socket.
+        """
         if self.token_service.token_needs_refreshing(self.token):
-            token_key_nonce = urandom(12)
-            self.token = self.token_service.create_encryption_token(encrypted_key=self.master_aesgcm.encrypt(token_key_nonce, self.key, None), nonce=token_key_nonce)
-        message_to_send = self._write_encrypted_data(message=message, token=self.token)
-        logging.debug(f"Sending message: {message_to_send}")
-        self.client.sendall(message_to_send)
+            self.token = self._create_encryption_token()
+        nonce = urandom(12)
+        with request_tracer.span("aes_gcm"):
+            encrypted_message = self._encrypt_into_send_buffer(nonce, message_parts)
+        logging.debug(f"Sending message: {message_parts[0][:100]} ({len(encrypted_message)} encrypted bytes)")
+        with request_tracer.span("send"):
+            self.connection.sendmsg([resume_flag, encryption_separator, self.token, encryption_separator, nonce,
+                                     encryption_separator, encrypted_message, end_flag])
         logging.debug("Message sent\n\n\n\n")
 
+    def _create_encryption_token(self) -> bytes:
+        kid, token_key_nonce, encrypted_key = self.keyring.seal(self.key)
+        return self.token_service.create_encryption_token(encrypted_key=encrypted_key, nonce=token_key_nonce, kid=kid)
+
+    def _encrypt_into_send_buffer(self, nonce: bytes, message_parts) -> memoryview:
+        # Same output as AESGCM.encrypt(nonce, b"".join(message_parts), None): the ciphertext followed by the tag
+        message_length = sum(len(part) for part in message_parts)
+        needed = message_length + gcm_block_size + gcm_tag_size  # update_into needs up to a block of slack
+        if len(self.send_buffer) < needed:
+            self.send_buffer = bytearray(needed)
+        buffer = memoryview(self.send_buffer)
+
+        encryptor = Cipher(algorithms.AES(self.key), modes.GCM(nonce)).encryptor()
+        offset = 0
+        for part in message_parts:
+            offset += encryptor.update_into(part, buffer[offset:])
+        encryptor.finalize()
+        buffer[offset:offset + gcm_tag_size] = encryptor.tag
+        return buffer[:offset + gcm_tag_size]
+
     def _write_encrypted_data(
             self,
             message: bytes,
@@ -115,7 +158,8 @@ class SecureCommunicationManager:
             encrypt_message: bool = True
             ) -> bytes:
         nonce = urandom(12)
-        encrypted_message = self.aesgcm.encrypt(nonce, message, None) if message != b"" and encrypt_message and self.aesgcm is not None else message
+        with request_tracer.span("aes_gcm"):
+            encrypted_message = self.aesgcm.encrypt(nonce, message, None) if message != b"" and encrypt_message and self.aesgcm is not None else message
         message = encryption_flag + encryption_separator + token + encryption_separator + nonce + encryption_separator + encrypted_message + end_flag
         logging.debug(f"Encrypted message: {message}")
         return message
@@ -1,44 +1,55 @@
 import logging
+import struct
 import uuid
 
 from DAOs.FilesDatabaseDAO import FilesDatabaseDAO
 from DAOs.FilesDiskDAO import FilesDiskDAO
+from Dependencies.Constants import search_max_page_size, write_batch_size, bulk_upload_batch_bytes, copy_batch_size
+from Services.FileContentsCache import FileContentsCache
 from Services.UsersService import UsersService
 
+bulk_upload_entry_header = struct.Struct(">HHQ")  # path, name and contents lengths in bytes, big-endian
+
 
 class FileService:
     def __init__(self, users_service: UsersService):
         self.files_database_dao = FilesDatabaseDAO()
         self.files_disk_dao = FilesDiskDAO()
+        self.file_contents_cache = FileContentsCache()
         self.users_service = users_service
 
     def create_file(self, file_owner, user_file_path, user_file_name, file_contents):
         file_owner_id = self.users_service.get_user_id(file_owner)
         logging.debug(f"Creating file for {file_owner}@{user_file_path if user_file_path != "/" else ""}/{user_file_name}.")
-        if self.can_create_file(file_owner, user_file_path, user_file_name):
-            # write to disk
-            file_uuid = self._file_uuid_generator()
-            self.files_disk_dao.write_file_to_disk(file_owner_id, file_uuid, file_contents)
-
-            # create in database
-            file_size = self.files_disk_dao.get_file_size_on_disk(file_owner_id, file_uuid)
-            self.files_database_dao.create_file(file_owner_id, user_file_path, file_uuid, user_file_name, file_size)
+        # write to disk; the blob is durable before any metadata points at it
+        file_uuid = self._file_uuid_generator()
+        self.files_disk_dao.write_file_to_disk(file_owner_id, file_uuid, file_contents)
+
+        # create in database; CREATE_FILE checked can_create_file already, a file created since then fails the unique index
+        try:
+            created = self.files_database_dao.create_file(file_owner_id, user_file_path, file_uuid, user_file_name, len(file_contents))
+        except Exception:
+            self.files_disk_dao.delete_file_from_disk(file_owner_id, file_uuid)
+            raise
 
+        if created:
             logging.debug(f"File {user_file_name} created.")
             return True
         else:
+            self.files_disk_dao.delete_file_from_disk(file_owner_id, file_uuid)
             logging.error("File already exists.")
             return False
 
     def delete_file(self, file_owner, user_file_path, user_file_name):
         file_owner_id = self.users_service.get_user_id(file_owner)
-        file_uuid = self.files_database_dao.get_file_uuid(file_owner_id, user_file_path, user_file_name)
-        if self.files_database_dao.does_file_exist(file_owner_id, user_file_path, user_file_name):
+        file = self.files_database_dao.get_file(file_owner_id, user_file_path, user_file_name)
+        if file is not None:
             # delete from disk
-            self.files_disk_dao.delete_file_from_disk(file_owner_id, file_uuid)
+            self.files_disk_dao.delete_file_from_disk(file_owner_id, file.file_uuid)
+            self.file_contents_cache.invalidate(file_owner_id, file.file_uuid)
 
             # delete from database
-            self.files_database_dao.delete_file(file_owner_id, user_file_path, user_file_name)
+            self.files_database_dao.delete_file_by_id(file.file_id)
 
             logging.debug(f"File {user_file_path if user_file_path != "/" else ""}/{user_file_name} deleted.")
             return True
@@ -151,13 +162,199 @@ class FileService:
             logging.error("Directory cannot be moved. Either it does not exist or a directory with the new name already exists.")
             return False
 
+    def copy_file(self, file_owner, user_file_path, user_file_name, new_user_file_path, new_user_file_name):
+        file_owner_id = self.users_service.get_user_id(file_owner)
+        source_file = self.files_database_dao.get_file(file_owner_id, user_file_path, user_file_name)
+        if source_file is not None and not self.files_database_dao.does_file_exist(file_owner_id, new_user_file_path, new_user_file_name):
+            logging.debug(f"Copying file {user_file_name} to {new_user_file_path}/{new_user_file_name}.")
+            file_uuid = self._file_uuid_generator()
+            self.files_disk_dao.copy_files_on_disk(file_owner_id, [(source_file.file_uuid, file_uuid)])
+            try:
+                created = self.files_database_dao.create_file(file_owner_id, new_user_file_path, file_uuid, new_user_file_name, source_file.file_size)
+            except Exception:
+                self.files_disk_dao.delete_file_from_disk(file_owner_id, file_uuid)
+                raise
+            if not created:
+                self.files_disk_dao.delete_file_from_disk(file_owner_id, file_uuid)
+            return created
+        else:
+            logging.error("File cannot be copied. Either it does not exist or a file with the new name already exists.")
+            return False
+
+    def copy_dir(self, file_owner, dir_path, dir_name, new_parent_dir_path, new_dir_name):
+        file_owner_id = self.users_service.get_user_id(file_owner)
+        old_full_path = f"{dir_path if dir_path != "/" else ""}/{dir_name}"
+        new_full_path = f"{new_parent_dir_path if new_parent_dir_path != "/" else ""}/{new_dir_name}"
+        if new_full_path == old_full_path or new_full_path.startswith(old_full_path + "/"):
+            logging.error("Directory cannot be copied into itself.")
+            return False
+        if self.files_database_dao.does_dir_exist(file_owner_id, dir_path, dir_name) and not self.files_database_dao.does_dir_exist(file_owner_id, new_parent_dir_path, new_dir_name):
+            logging.debug(f"Copying directory {old_full_path} to {new_full_path}. \nGetting all items in directory...")
+            dir_items = [self._item_row(file_owner_id, new_parent_dir_path, new_dir_name)]
+            file_items = []
+            file_uuid_pairs = []
+            for item in self.files_database_dao.get_all_items_under_path(file_owner_id, old_full_path):
+                new_path = new_full_path + item.user_file_path[len(old_full_path):]
+                if item.is_directory:
+                    dir_items.append(self._item_row(file_owner_id, new_path, item.user_file_name))
+                else:
+                    file_uuid = self._file_uuid_generator()
+                    file_uuid_pairs.append((item.file_uuid, file_uuid))
+                    file_items.append(self._item_row(file_owner_id, new_path, item.user_file_name, file_uuid, item.file_size))
+
+            if not self.files_database_dao.create_items(dir_items):
+                logging.error("Directory cannot be copied. A directory with the new name was created meanwhile.")
+                return False
+            # the files a batch at a time, like BULK_UPLOAD, so a large copy doesn't leave its first blobs without rows;
+            # a copy that fails part way keeps the files copied so far
+            for start in range(0, len(file_items), copy_batch_size):
+                batch_pairs = file_uuid_pairs[start:start + copy_batch_size]
+                self._create_items_after_blobs(file_owner_id, [], file_items[start:start + copy_batch_size],
+                                               lambda: self.files_disk_dao.copy_files_on_disk(file_owner_id, batch_pairs))
+            logging.debug(f"Directory copied with {len(file_uuid_pairs)} files.")
+            return True
+        else:
+            logging.error("Directory cannot be copied. Either it does not exist or a directory with the new name already exists.")
+            return False
+
+    def bulk_upload(self, file_owner, frames):
+        """
+        Creates the files of a BULK_UPLOAD stream. frames yields its decrypted payloads, each made of whole entries:
+        bulk_upload_entry_header (path, name and contents lengths) followed by the UTF-8 path, name and contents.
+        Missing parent directories are created. Blobs are written and rows inserted write_batch_size files (or
+        bulk_upload_batch_bytes) at a time, so neither the fsyncs nor the transactions are paid per file.
+        Returns a BulkUploadResult per entry, in stream order. Raises ValueError for a malformed frame, once the
+        entries before it have been created.
+        """
+        file_owner_id = self.users_service.get_user_id(file_owner)
+        results = []
+        known_dirs = set()  # (path, name) of directories known to exist or already part of a batch
+        seen_files = set()
+        batch = []  # (result, file_contents)
+        batch_bytes = 0
+        for frame in frames:
+            for user_file_path, user_file_name, file_contents in self._parse_bulk_upload_frame(frame):
+                result = BulkUploadResult(user_file_path, user_file_name, "INVALID_PATH")
+                results.append(result)
+                if not self._is_valid_bulk_upload_path(user_file_path, user_file_name):
+                    continue
+                if (user_file_path, user_file_name) in seen_files or self.files_database_dao.does_file_exist(file_owner_id, user_file_path, user_file_name):
+                    result.status = "FILE_EXISTS"
+                    continue
+                seen_files.add((user_file_path, user_file_name))
+                result.status = None  # until its batch is committed
+                batch.append((result, file_contents))
+                batch_bytes += len(file_contents)
+                if len(batch) >= write_batch_size or batch_bytes >= bulk_upload_batch_bytes:
+                    self._create_bulk_upload_batch(file_owner_id, batch, known_dirs)
+                    batch, batch_bytes = [], 0
+        if batch:
+            self._create_bulk_upload_batch(file_owner_id, batch, known_dirs)
+        logging.debug(f"Bulk upload for {file_owner} finished: {sum(result.status == "FILE_CREATED" for result in results)} of {len(results)} files created.")
+        return results
+
+    def _create_bulk_upload_batch(self, file_owner_id, batch, known_dirs):
+        dir_items = []
+        for result, _ in batch:
+            for dir_path, dir_name in self._get_parent_dirs(result.path):
+                if (dir_path, dir_name) not in known_dirs:
+                    known_dirs.add((dir_path, dir_name))
+                    if not self.files_database_dao.does_dir_exist(file_owner_id, dir_path, dir_name):
+                        dir_items.append(self._item_row(file_owner_id, dir_path, dir_name))
+        file_uuids = [self._file_uuid_generator() for _ in batch]
+        file_items = [self._item_row(file_owner_id, result.path, result.name, file_uuid, len(file_contents))
+                      for (result, file_contents), file_uuid in zip(batch, file_uuids)]
+        created = self._create_items_after_blobs(
+            file_owner_id, dir_items, file_items,
+            lambda: self.files_disk_dao.write_files_to_disk(file_owner_id, [(file_uuid, file_contents) for (_, file_contents), file_uuid in zip(batch, file_uuids)]))
+        for (result, _), was_created in zip(batch, created):
+            result.status = "FILE_CREATED" if was_created else "FILE_EXISTS"
+
+    def _item_row(self, file_owner_id, user_file_path, user_file_name, file_uuid=None, file_size=0):
+        """A FilesDB row for create_items: a file when it has a file_uuid, else a directory."""
+        # every row needs the same keys, insert_many takes its columns from the first one
+        return {"file_owner_id": file_owner_id, "user_file_path": user_file_path, "user_file_name": user_file_name,
+                "file_uuid": file_uuid, "file_size": file_size, "is_directory": file_uuid is None}
+
+    def _create_items_after_blobs(self, file_owner_id, dir_items, file_items, place_blobs):
+        """
+        Calls place_blobs to put the blobs of file_items on disk, then inserts dir_items and file_items in one
+        transaction. Blobs go first, so committed rows never point at missing blobs, and callers pass a batch at a
+        time, so no blob waits long for its row: the storage scrubber quarantines blobs that have had none for
+        scrubber_orphan_grace_seconds. If another request created one of the items meanwhile, the rows are inserted
+        one at a time instead and the blobs of files that already exist are deleted.
+        Returns whether each of file_items was created.
+        """
+        created = []
+        try:
+            place_blobs()
+            if self.files_database_dao.create_items(dir_items + file_items):
+                return [True] * len(file_items)
+            for item in dir_items:
+                if not self.files_database_dao.does_dir_exist(file_owner_id, item["user_file_path"], item["user_file_name"]):
+                    self.files_database_dao.create_dir(file_owner_id, item["user_file_path"], item["user_file_name"])
+            for item in file_items:
+                created.append(self.files_database_dao.create_file(file_owner_id, item["user_file_path"], item["file_uuid"], item["user_file_name"], item["file_size"]))
+                if not created[-1]:
+                    self._delete_blobs(file_owner_id, [item["file_uuid"]])
+        except Exception:
+            self._delete_blobs(file_owner_id, [item["file_uuid"] for item in file_items[len(created):]])
+            raise
+        return created
+
+    def _parse_bulk_upload_frame(self, frame):
+        frame = memoryview(frame)
+        offset = 0
+        while offset < len(frame):
+            if offset + bulk_upload_entry_header.size > len(frame):
+                raise ValueError("Truncated bulk upload entry header.")
+            path_length, name_length, contents_length = bulk_upload_entry_header.unpack_from(frame, offset)
+            offset += bulk_upload_entry_header.size
+            if offset + path_length + name_length + contents_length > len(frame):
+                raise ValueError("Truncated bulk upload entry.")
+            user_file_path = str(frame[offset:offset + path_length], "utf-8", "replace")
+            offset += path_length
+            user_file_name = str(frame[offset:offset + name_length], "utf-8", "replace")
+            offset += name_length
+            # a view into the frame, so the contents are not copied before they reach the disk
+            yield user_file_path, user_file_name, frame[offset:offset + contents_length]
+            offset += contents_length
+
+    def _is_valid_bulk_upload_path(self, user_file_path, user_file_name):
+        if "\ufffd" in user_file_path + user_file_name or not user_file_path.startswith("/"):
+            return False
+        if user_file_name in ("", ".", "..") or "/" in user_file_name:
+            return False
+        return user_file_path == "/" or all(part not in ("", ".", "..") for part in user_file_path[1:].split("/"))
+
+    def _get_parent_dirs(self, user_file_path):
+        """(path, name) of every directory from the root down to user_file_path, excluding the root itself."""
+        parent_dirs = []
+        dir_path = "/"
+        for dir_name in user_file_path[1:].split("/") if user_file_path != "/" else []:
+            parent_dirs.append((dir_path, dir_name))
+            dir_path = f"{dir_path if dir_path != "/" else ""}/{dir_name}"
+        return parent_dirs
+
+    def _delete_blobs(self, file_owner_id, file_uuids):
+        for file_uuid in file_uuids:
+            try:
+                self.files_disk_dao.delete_file_from_disk(file_owner_id, file_uuid)
+            except FileNotFoundError:
+                pass
+
     def get_file_contents(self, file_owner, user_file_path, file_name):
         logging.debug(f"Getting file contents for {file_owner}@{user_file_path}/{file_name}.")
         file_owner_id = self.users_service.get_user_id(file_owner)
         logging.debug(f"{file_owner} user id: {file_owner_id} \n Getting file uuid...")
         file_uuid = self.files_database_dao.get_file_uuid(file_owner_id, user_file_path, file_name)
-        logging.debug(f"File uuid: {file_uuid}\n Getting file contents from disk...")
-        file_contents = self.files_disk_dao.get_file_contents(file_owner_id, file_uuid)
+        if file_uuid is None:
+            raise FileNotFoundError(f"{file_owner}@{user_file_path}/{file_name} does not exist.")
+        file_contents = self.file_contents_cache.get(file_owner_id, file_uuid)
+        if file_contents is None:
+            logging.debug(f"File uuid: {file_uuid}\n Getting file contents from disk...")
+            file_contents = self.files_disk_dao.get_file_contents(file_owner_id, file_uuid)
+            self.file_contents_cache.put(file_owner_id, file_uuid, file_contents)
         return file_contents
 
 
@@ -187,6 +384,21 @@ class FileService:
         logging.debug(f"File tuples list: {[file.__dict__ for file in files_list]}")
         return files_list
 
+    def search(self, file_owner, query, match, item_type, min_size, max_size, cursor, page_size):
+        """Returns one page of SearchResults and the cursor of the next page, which is None on the last page."""
+        if match not in ("substring", "prefix") or item_type not in ("any", "file", "dir") or page_size < 1:
+            raise ValueError("Invalid search parameters.")
+        file_owner_id = self.users_service.get_user_id(file_owner)
+        page_size = min(page_size, search_max_page_size)
+        is_directory = {"any": None, "file": False, "dir": True}[item_type]
+        rows = self.files_database_dao.search(file_owner_id, query, match == "prefix", is_directory, min_size, max_size,
+                                              cursor, page_size + 1)
+        next_cursor = rows[page_size - 1][0] if len(rows) > page_size else None
+        results = [SearchResult(user_file_path, user_file_name, bool(is_dir), file_size)
+                   for _, user_file_path, user_file_name, is_dir, file_size in rows[:page_size]]
+        logging.debug(f"Search for {query!r} found {len(results)} items, next cursor: {next_cursor}.")
+        return results, next_cursor
+
     def _file_uuid_generator(self):
         return uuid.uuid4().hex
 
@@ -213,6 +425,19 @@ class File:
         self.name = name
         self.size = size
 
+class SearchResult:
+    def __init__(self, path, name, is_directory, size):
+        self.path = path
+        self.name = name
+        self.is_directory = is_directory
+        self.size = size
+
+class BulkUploadResult:
+    def __init__(self, path, name, status):
+        self.path = path
+        self.name = name
+        self.status = status
+
 class Items:
     def __init__(self, dirs_dumps, files_dumps):
         self.dirs_dumps = dirs_dumps
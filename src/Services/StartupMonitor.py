@@ -0,0 +1,90 @@
+import json
+import logging
+import os
+import socket
+import time
+from contextlib import contextmanager
+
+from Dependencies.Constants import ready_file_path
+
+
+class StartupTimer:
+    """Wall time of each startup phase, logged as the phase ends and exposed in ADMIN_GET_STATS."""
+    def __init__(self):
+        self.started_at = time.perf_counter()
+        self.before_timer_seconds = _seconds_since_process_start()  # interpreter start and imports
+        self.phases = {}
+        self.ready_after_seconds = None
+
+    @contextmanager
+    def phase(self, name):
+        phase_started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = time.perf_counter() - phase_started_at
+            logging.info(f"Startup phase {name} took {self.phases[name] * 1000:.1f} ms.")
+
+    def finish(self):
+        self.ready_after_seconds = time.perf_counter() - self.started_at
+        imports = f" (+{self.before_timer_seconds * 1000:.0f} ms interpreter start and imports)" if self.before_timer_seconds is not None else ""
+        logging.info(f"Ready to serve {self.ready_after_seconds * 1000:.1f} ms after startup began{imports}.")
+
+    def get_stats(self):
+        return {
+            "before_timer_ms": round(self.before_timer_seconds * 1000, 1) if self.before_timer_seconds is not None else None,
+            "phases_ms": {name: round(seconds * 1000, 1) for name, seconds in self.phases.items()},
+            "ready_after_ms": round(self.ready_after_seconds * 1000, 1) if self.ready_after_seconds is not None else None,
+        }
+
+
+class ReadinessNotifier:
+    """
+    Tells the outside world that the server accepts connections: a log line, the ready file
+    (removed again on shutdown) for scripts and health checks, and READY=1 for systemd's Type=notify
+    when NOTIFY_SOCKET is set.
+    """
+    def __init__(self, path=ready_file_path):
+        self.path = path
+
+    def notify_ready(self):
+        temp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(temp_path, "w") as file:
+            json.dump({"pid": os.getpid(), "ready_at": time.time()}, file)
+        os.replace(temp_path, self.path)
+        self._notify_systemd(b"READY=1")
+        logging.info("Server ready.")
+
+    def notify_stopping(self):
+        self._notify_systemd(b"STOPPING=1")
+        try:
+            with open(self.path) as file:
+                is_ours = json.load(file)["pid"] == os.getpid()
+            if is_ours:
+                os.remove(self.path)
+        except (FileNotFoundError, ValueError, KeyError):
+            pass
+
+    def _notify_systemd(self, message):
+        address = os.environ.get("NOTIFY_SOCKET")
+        if not address or not hasattr(socket, "AF_UNIX"):
+            return
+        if address.startswith("@"):
+            address = "\0" + address[1:]  # abstract namespace
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as notify_socket:
+                notify_socket.sendto(message, address)
+        except OSError as exception:
+            logging.warning(f"Could not notify systemd: {exception}")
+
+
+def _seconds_since_process_start():
+    # Linux only: process start time and system uptime, both in clock ticks since boot
+    try:
+        with open("/proc/self/stat") as file:
+            start_ticks = int(file.read().rsplit(")", 1)[1].split()[19])
+        with open("/proc/uptime") as file:
+            uptime_seconds = float(file.read().split()[0])
+    except (OSError, IndexError, ValueError):
+        return None
+    return uptime_seconds - start_ticks / os.sysconf("SC_CLK_TCK")
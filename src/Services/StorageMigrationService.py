@@ -0,0 +1,89 @@
+import argparse
+import json
+import logging
+import os
+import time
+
+from DAOs.FilesDiskDAO import FilesDiskDAO, blob_name_pattern
+from Dependencies.Constants import server_storage_path, storage_migration_checkpoint_path
+
+
+class StorageMigrationService:
+    """
+    Moves blobs from the flat <owner_id>/<file_uuid> layout into the sharded layout while the server keeps running.
+    Each blob is moved with a single rename, and FilesDiskDAO looks in both layouts, so readers never miss a file.
+    Migrated blobs leave the flat directory, so an interrupted run simply continues with what is left;
+    the checkpoint file additionally records owners that are already done so they are not rescanned.
+    """
+    def __init__(self, files_disk_dao: FilesDiskDAO, checkpoint_path=storage_migration_checkpoint_path):
+        self.files_disk_dao = files_disk_dao
+        self.checkpoint_path = checkpoint_path
+        self.checkpoint = self._load_checkpoint()
+
+    def migrate(self, files_per_second=0, checkpoint_every=1000):
+        logging.info(f"Migrating blobs in {server_storage_path}. Already migrated: {self.checkpoint['moved']} blobs.")
+        completed_owners = set(self.checkpoint["completed_owners"])
+        for owner_dir in sorted(self._get_owner_dirs(), key=int):
+            if owner_dir in completed_owners:
+                continue
+            moved = self._migrate_owner(owner_dir, files_per_second, checkpoint_every)
+            self.checkpoint["completed_owners"].append(owner_dir)
+            self._save_checkpoint()
+            logging.info(f"Owner {owner_dir} migrated ({moved} blobs).")
+        logging.info(f"Migration finished. {self.checkpoint['moved']} blobs moved in total.")
+
+    def _migrate_owner(self, owner_dir, files_per_second, checkpoint_every):
+        moved = 0
+        with os.scandir(os.path.join(server_storage_path, owner_dir)) as entries:
+            for entry in entries:
+                if not entry.is_file(follow_symlinks=False) or not blob_name_pattern.match(entry.name):
+                    continue
+                if self._move_blob(owner_dir, entry.name):
+                    moved += 1
+                    self.checkpoint["moved"] += 1
+                    if self.checkpoint["moved"] % checkpoint_every == 0:
+                        self._save_checkpoint()
+                if files_per_second > 0:
+                    time.sleep(1 / files_per_second)
+        return moved
+
+    def _move_blob(self, owner_dir, file_uuid):
+        flat_path = self.files_disk_dao.get_flat_file_path(owner_dir, file_uuid)
+        sharded_path = self.files_disk_dao.get_full_file_path(owner_dir, file_uuid)
+        if os.path.exists(sharded_path):
+            logging.error(f"Not migrating {flat_path}: {sharded_path} already exists.")
+            return False
+        self.files_disk_dao.ensure_dir_exists(os.path.dirname(sharded_path))
+        try:
+            os.rename(flat_path, sharded_path)
+        except FileNotFoundError:
+            # deleted by the server since the directory was listed
+            return False
+        return True
+
+    def _get_owner_dirs(self):
+        with os.scandir(server_storage_path) as entries:
+            return [entry.name for entry in entries if entry.is_dir(follow_symlinks=False) and entry.name.isdigit()]
+
+    def _load_checkpoint(self):
+        try:
+            with open(self.checkpoint_path) as file:
+                return json.load(file)
+        except FileNotFoundError:
+            return {"completed_owners": [], "moved": 0}
+
+    def _save_checkpoint(self):
+        temp_path = self.checkpoint_path + ".tmp"
+        with open(temp_path, "w") as file:
+            json.dump(self.checkpoint, file)
+        os.replace(temp_path, self.checkpoint_path)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description="Moves flat-layout blobs into the sharded layout. Safe to run while the server is up, and to rerun after an interruption.")
+    parser.add_argument("--files-per-second", type=float, default=0, help="rate limit, 0 for unlimited")
+    args = parser.parse_args()
+
+    StorageMigrationService(FilesDiskDAO()).migrate(files_per_second=args.files_per_second)
@@ -0,0 +1,218 @@
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+
+from DAOs.FilesDatabaseDAO import FilesDatabaseDAO
+from DAOs.FilesDiskDAO import FilesDiskDAO, blob_name_pattern
+from Dependencies.Constants import server_storage_path, scrubber_interval_seconds, scrubber_batch_size, \
+    scrubber_max_entries_per_second, scrubber_orphan_grace_seconds, scrubber_verify_sizes, scrubber_checkpoint_path, \
+    scrubber_lock_path, quarantine_path
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+
+class StorageScrubberService:
+    """
+    Background reconciliation of blobs on disk against FilesDB, in two phases:
+    the disk phase walks every owner directory and quarantines blobs without a row,
+    the database phase walks FilesDB by file_id and reports rows whose blob is missing
+    (and, with scrubber_verify_sizes, blobs whose size differs from file_size).
+    Work is done in batches of scrubber_batch_size and throttled to scrubber_max_entries_per_second,
+    and progress is checkpointed (at most once a second) so a restarted server resumes the pass where it stopped.
+    """
+    def __init__(self, files_database_dao: FilesDatabaseDAO, files_disk_dao: FilesDiskDAO):
+        self.files_database_dao = files_database_dao
+        self.files_disk_dao = files_disk_dao
+        self.checkpoint = self._load_checkpoint()
+        self._lock = threading.Lock()
+        self.passes = 0
+        self.orphans_quarantined = 0
+        self.dangling_rows = deque(maxlen=100)
+        self.dangling_row_count = 0
+        self.size_mismatches = deque(maxlen=100)
+        self.size_mismatch_count = 0
+        self._entry_budget_started_at = time.monotonic()
+        self._entries_in_budget = 0
+        self._checkpoint_saved_at = 0.0
+
+    def start(self):
+        if not self._acquire_scrubber_lock():
+            logging.info("Another worker process runs the storage scrubber.")
+            return
+        threading.Thread(target=self._run, name="StorageScrubber", daemon=True).start()
+
+    def run_pass(self):
+        if self.checkpoint["phase"] == "disk":
+            self._scrub_disk()
+            self.checkpoint = {"phase": "database", "last_file_id": 0}
+            self._save_checkpoint()
+        self._scrub_database()
+        self.checkpoint = {"phase": "disk", "last_dir": None}
+        self._save_checkpoint()
+        with self._lock:
+            self.passes += 1
+        logging.info("Storage scrub pass finished.")
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                "passes": self.passes,
+                "checkpoint": dict(self.checkpoint),
+                "orphans_quarantined": self.orphans_quarantined,
+                "dangling_rows": self.dangling_row_count,
+                "recent_dangling_rows": list(self.dangling_rows),
+                "size_mismatches": self.size_mismatch_count,
+                "recent_size_mismatches": list(self.size_mismatches),
+            }
+
+    def _run(self):
+        while True:
+            try:
+                self.run_pass()
+            except Exception:
+                logging.exception("Storage scrub pass failed.")
+            time.sleep(scrubber_interval_seconds)
+
+    # Disk phase
+
+    def _scrub_disk(self):
+        last_dir = tuple(self.checkpoint["last_dir"]) if self.checkpoint.get("last_dir") else None
+        for owner_dir in sorted(self._list_owner_dirs(), key=int):
+            for dir_parts in self._walk_blob_dirs(owner_dir, ()):
+                position = (int(owner_dir), *dir_parts)
+                if last_dir is not None and position <= last_dir:
+                    continue
+                self._scrub_blob_dir(owner_dir, dir_parts)
+                self.checkpoint["last_dir"] = position
+                self._save_checkpoint(at_most_every_second=True)
+
+    def _walk_blob_dirs(self, owner_dir, dir_parts):
+        # the owner directory itself (flat layout) first, then the shard directories in sorted order
+        yield dir_parts
+        if len(dir_parts) < self.files_disk_dao.shard_levels:
+            for sub_dir in sorted(self._list_dirs(os.path.join(server_storage_path, owner_dir, *dir_parts))):
+                yield from self._walk_blob_dirs(owner_dir, (*dir_parts, sub_dir))
+
+    def _scrub_blob_dir(self, owner_dir, dir_parts):
+        dir_path = os.path.join(server_storage_path, owner_dir, *dir_parts)
+        batch = []
+        with os.scandir(dir_path) as entries:
+            for entry in entries:
+                if entry.is_file(follow_symlinks=False) and blob_name_pattern.match(entry.name):
+                    batch.append(entry.name)
+                    if len(batch) >= scrubber_batch_size:
+                        self._scrub_blob_batch(int(owner_dir), dir_path, batch)
+                        batch = []
+        if batch:
+            self._scrub_blob_batch(int(owner_dir), dir_path, batch)
+
+    def _scrub_blob_batch(self, file_owner_id, dir_path, file_uuids):
+        self._throttle(len(file_uuids))
+        known_uuids = self.files_database_dao.get_file_sizes_by_uuid(file_owner_id, file_uuids)
+        for file_uuid in file_uuids:
+            if file_uuid in known_uuids:
+                continue
+            blob_path = os.path.join(dir_path, file_uuid)
+            try:
+                # uploads rename the blob into place just before inserting its row, so recent blobs are left alone
+                if os.path.getmtime(blob_path) > time.time() - scrubber_orphan_grace_seconds:
+                    continue
+            except FileNotFoundError:
+                continue
+            # re-check: the row may have been committed since the batch was queried
+            if not self.files_database_dao.get_file_sizes_by_uuid(file_owner_id, [file_uuid]):
+                self._quarantine(file_owner_id, blob_path, file_uuid)
+
+    def _quarantine(self, file_owner_id, blob_path, file_uuid):
+        owner_quarantine_path = os.path.join(quarantine_path, str(file_owner_id))
+        os.makedirs(owner_quarantine_path, exist_ok=True)
+        try:
+            os.rename(blob_path, os.path.join(owner_quarantine_path, file_uuid))
+        except FileNotFoundError:
+            return
+        with self._lock:
+            self.orphans_quarantined += 1
+        logging.warning(f"Quarantined orphan blob {blob_path}")
+
+    # Database phase
+
+    def _scrub_database(self):
+        while True:
+            files = self.files_database_dao.get_files_after_id(self.checkpoint["last_file_id"], scrubber_batch_size)
+            if not files:
+                return
+            self._throttle(len(files))
+            for file in files:
+                self._check_row(file)
+            self.checkpoint["last_file_id"] = files[-1].file_id
+            self._save_checkpoint(at_most_every_second=True)
+
+    def _check_row(self, file):
+        try:
+            size_on_disk = self.files_disk_dao.get_file_size_on_disk(file.file_owner_id, file.file_uuid)
+        except FileNotFoundError:
+            # re-check: the file may have been deleted since the batch was queried
+            if self.files_database_dao.does_file_id_exist(file.file_id):
+                row = {"file_id": file.file_id, "file_owner_id": file.file_owner_id, "file_uuid": file.file_uuid}
+                with self._lock:
+                    self.dangling_rows.append(row)
+                    self.dangling_row_count += 1
+                logging.error(f"FilesDB row without a blob: {row}")
+            return
+        if scrubber_verify_sizes and size_on_disk != file.file_size:
+            mismatch = {"file_id": file.file_id, "file_size": file.file_size, "size_on_disk": size_on_disk}
+            with self._lock:
+                self.size_mismatches.append(mismatch)
+                self.size_mismatch_count += 1
+            logging.error(f"Blob size differs from FilesDB: {mismatch}")
+
+    # Helpers
+
+    def _throttle(self, entries):
+        # simple rate limit: sleep once the entries of the current second are used up
+        self._entries_in_budget += entries
+        elapsed = time.monotonic() - self._entry_budget_started_at
+        if self._entries_in_budget >= scrubber_max_entries_per_second:
+            time.sleep(max(0.0, self._entries_in_budget / scrubber_max_entries_per_second - elapsed))
+            self._entry_budget_started_at = time.monotonic()
+            self._entries_in_budget = 0
+
+    def _list_owner_dirs(self):
+        return [name for name in self._list_dirs(server_storage_path) if name.isdigit()]
+
+    def _list_dirs(self, path):
+        with os.scandir(path) as entries:
+            return [entry.name for entry in entries if entry.is_dir(follow_symlinks=False) and not entry.name.startswith(".")]
+
+    def _acquire_scrubber_lock(self):
+        if fcntl is None:
+            return True
+        self._lock_file = open(scrubber_lock_path, "w")
+        try:
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+        except OSError:
+            self._lock_file.close()
+            return False
+
+    def _load_checkpoint(self):
+        try:
+            with open(scrubber_checkpoint_path) as file:
+                return json.load(file)
+        except (FileNotFoundError, ValueError):
+            return {"phase": "disk", "last_dir": None}
+
+    def _save_checkpoint(self, at_most_every_second=False):
+        if at_most_every_second and time.monotonic() - self._checkpoint_saved_at < 1:
+            return
+        self._checkpoint_saved_at = time.monotonic()
+        temp_path = scrubber_checkpoint_path + ".tmp"
+        with open(temp_path, "w") as file:
+            json.dump(self.checkpoint, file)
+        os.replace(temp_path, scrubber_checkpoint_path)
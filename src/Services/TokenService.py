@@ -4,19 +4,23 @@ from base64 import b64encode, b64decode
 import jwt
 from jwt import DecodeError
 
-from Dependencies.Constants import private_key, public_key
+from Dependencies.Constants import get_private_key, get_public_key
+from Dependencies.RequestTracer import request_tracer
 
 
 class TokenService:
     def __init__(self):
-        self.private_key = private_key
-        self.public_key = public_key
+        self.private_key = get_private_key()
+        self.public_key = get_public_key()
 
     def create_login_token(self, username) -> str:
-        return jwt.encode({"username": username, "exp": int(time.time() + 60*60)}, self.private_key, algorithm="RS256")
+        with request_tracer.span("token_sign"):
+            return jwt.encode({"username": username, "exp": int(time.time() + 60*60)}, self.private_key, algorithm="RS256")
                                                                         # 60 minutes
-    def create_encryption_token(self, encrypted_key, nonce) -> bytes:
-        enc_token = jwt.encode({"encrypted_key": b64encode(encrypted_key).decode(), "exp": int(time.time() + 60 * 60), "nonce": b64encode(nonce).decode()}, self.private_key, algorithm="RS256").encode()
+    def create_encryption_token(self, encrypted_key, nonce, kid) -> bytes:
+        # kid names the master key that encrypted the session key
+        with request_tracer.span("token_sign"):
+            enc_token = jwt.encode({"encrypted_key": b64encode(encrypted_key).decode(), "exp": int(time.time() + 60 * 60), "nonce": b64encode(nonce).decode(), "kid": kid}, self.private_key, algorithm="RS256").encode()
         return enc_token
                                                               # 60 minutes
     def is_token_valid(self, token_to_validate):
@@ -39,11 +43,12 @@ class TokenService:
     def decode_token(self, token_to_decode):
         if isinstance(token_to_decode, bytes):
             token_to_decode = token_to_decode.decode()
-        return jwt.decode(token_to_decode, self.public_key, algorithms=["RS256"])
+        with request_tracer.span("token_verify"):
+            return jwt.decode(token_to_decode, self.public_key, algorithms=["RS256"])
 
 
 if __name__ == "__main__":
     ts = TokenService()
-    token = ts.create_encryption_token(b"abcdefg", b"1234567890")
+    token = ts.create_encryption_token(b"abcdefg", b"1234567890", "example")
     print(token)
     print(b64decode(ts.decode_token(token)["encrypted_key"].encode()), b64decode(ts.decode_token(token)["nonce"].encode()))
\ No newline at end of file
@@ -1,17 +1,20 @@
+import hmac
 import logging
 
-from src.DAOs.UsersDatabaseDAO import UsersDatabaseDAO
+from DAOs.UsersDatabaseDAO import UsersDatabaseDAO
+from Services.PasswordHasher import PasswordHasher
 
 
 class UsersService:
-    def __init__(self):
+    def __init__(self, password_hasher: PasswordHasher = None):
         self.dao = UsersDatabaseDAO()
+        self.password_hasher = password_hasher if password_hasher is not None else PasswordHasher()
 
     def create_user(self, username, password_hash):
         logging.debug("Checking if user exists already")
         if not self.dao.does_user_exist(username):
             logging.debug("User does not exist. Creating...")
-            self.dao.create_user(username, password_hash)
+            self.dao.create_user(username, self.password_hasher.hash_password(password_hash))
             logging.debug(f"User {username} created.")
 
             return True
@@ -20,12 +23,26 @@ class UsersService:
             return False
 
     def login(self, username, password_hash):
-        logging.info(f"Logging in User, {username}, {password_hash}")
-        if self.dao.does_user_exist(username):
-            return self.dao.check_username_against_password_hash(username, password_hash)
-        else:
+        logging.info(f"Logging in User, {username}")
+        stored_hash = self.dao.get_password_hash(username)
+        if stored_hash is None:
+            # as slow as a wrong password, so response times don't tell which usernames exist
+            self.password_hasher.verify_password(password_hash, self.password_hasher.dummy_hash)
+            return False
+
+        if self.password_hasher.is_hashed(stored_hash):
+            if not self.password_hasher.verify_password(password_hash, stored_hash):
+                return False
+        elif not hmac.compare_digest(stored_hash.encode(), password_hash.encode()):
+            # stored before server-side hashing, compared as it was then
+            self.password_hasher.verify_password(password_hash, self.password_hasher.dummy_hash)
             return False
 
+        if self.password_hasher.needs_rehash(stored_hash):
+            self.dao.update_password_hash(username, stored_hash, self.password_hasher.hash_password(password_hash))
+            logging.debug(f"Password hash of {username} upgraded.")
+        return True
+
     def delete_user(self, username):
         self.dao.delete_user(username)
         logging.debug(f"User {username} deleted.")
@@ -0,0 +1,142 @@
+import logging
+import os
+import signal
+import select
+import sys
+import time
+
+from Dependencies.Constants import server_worker_processes, worker_restart_backoff_seconds, max_worker_startup_failures, \
+    supervisor_poll_seconds
+from Services.MasterKeyring import MasterKeyring
+from Services.StartupMonitor import ReadinessNotifier
+
+
+class WorkerSupervisor:
+    """
+    Pre-fork supervisor for running several server processes on the same address.
+    Each worker binds its own listening socket with SO_REUSEPORT and the kernel spreads connections between them.
+    The token master keyring is loaded once here, before forking, so workers don't each unseal it and every worker
+    can unwrap encryption tokens minted by any other worker (or by a previous run of the server).
+    Workers report over a pipe once they are listening; the supervisor signals readiness when all of them have.
+    The supervisor runs no threads, so nothing it holds is copied half-locked into a forked worker.
+    Workers that exit are restarted. A worker that exits before it was listening, or right after starting, is
+    restarted after a backoff that doubles with each such failure; after max_worker_startup_failures in a row
+    the supervisor gives up and exits with an error.
+    """
+    def __init__(self, start_worker, worker_count=server_worker_processes):
+        self.start_worker = start_worker  # called in the forked child with the shared keyring and a readiness callback
+        self.worker_count = worker_count
+        self.keyring = MasterKeyring()
+        self.readiness_notifier = ReadinessNotifier()
+        self._ready_read, self._ready_write = os.pipe()
+        self._ready_reports = b""
+        self.workers = {}  # pid -> (worker index, start time)
+        self.pending_restarts = {}  # worker index -> time.monotonic() at which it is started again
+        self.ready_workers = set()  # indexes of workers whose current process is listening
+        self.startup_failures = [0] * worker_count  # in a row, per worker index
+        self.is_ready = False
+        self.is_running = True
+        self.exit_code = 0
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self._handle_termination)
+        logging.info(f"Starting {self.worker_count} worker processes.")
+        try:
+            for index in range(self.worker_count):
+                self._spawn_worker(index)
+
+            while self.is_running:
+                now = time.monotonic()
+                for index, restart_at in list(self.pending_restarts.items()):
+                    if restart_at <= now:
+                        del self.pending_restarts[index]
+                        self._spawn_worker(index)
+                next_restart = min(self.pending_restarts.values(), default=now + supervisor_poll_seconds)
+                self._read_ready_reports(timeout=max(min(next_restart - now, supervisor_poll_seconds), 0))
+                while self.is_running:
+                    try:
+                        pid, status = os.waitpid(-1, os.WNOHANG)
+                    except ChildProcessError:  # every worker is waiting for its restart
+                        break
+                    if pid == 0:
+                        break
+                    if pid in self.workers:
+                        self._handle_worker_exit(pid, status)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.is_running = False
+            self._stop_workers()
+            self.readiness_notifier.notify_stopping()
+            logging.info("Supervisor Closed.")
+        if self.exit_code:
+            sys.exit(self.exit_code)
+
+    def _handle_worker_exit(self, pid, status):
+        self._read_ready_reports(timeout=0)  # it may have reported just before exiting
+        index, started_at = self.workers.pop(pid)
+        was_listening = index in self.ready_workers
+        self.ready_workers.discard(index)
+        logging.error(f"Worker {index} (pid {pid}) exited with status {os.waitstatus_to_exitcode(status)}.")
+        if was_listening and time.monotonic() - started_at >= worker_restart_backoff_seconds:
+            self.startup_failures[index] = 0
+            self._spawn_worker(index)
+            return
+
+        self.startup_failures[index] += 1
+        if self.startup_failures[index] >= max_worker_startup_failures:
+            logging.critical(f"Worker {index} failed to start {self.startup_failures[index]} times in a row. Giving up.")
+            self.is_running = False
+            self.exit_code = 1
+            return
+        backoff = worker_restart_backoff_seconds * 2 ** (self.startup_failures[index] - 1)
+        logging.warning(f"Restarting worker {index} in {backoff}s.")
+        self.pending_restarts[index] = time.monotonic() + backoff
+
+    def _spawn_worker(self, index):
+        pid = os.fork()
+        if pid == 0:
+            exit_code = 0
+            try:
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)  # until the server installs its own handler
+                signal.signal(signal.SIGINT, signal.SIG_DFL)
+                os.close(self._ready_read)
+                self.start_worker(self.keyring, lambda: os.write(self._ready_write, bytes([index % 256])))
+            except SystemExit as exception:  # the server's SIGTERM handler, after it has closed the server
+                exit_code = exception.code if isinstance(exception.code, int) else 1
+            except BaseException:
+                logging.exception(f"Worker {index} crashed.")
+                exit_code = 1
+            finally:
+                logging.shutdown()
+                os._exit(exit_code)
+
+        self.workers[pid] = (index, time.monotonic())
+        logging.info(f"Worker {index} started (pid {pid}).")
+
+    def _read_ready_reports(self, timeout):
+        # each worker writes one byte, its index, once it is listening
+        readable, _, _ = select.select([self._ready_read], [], [], timeout)
+        if not readable:
+            return
+        for index in os.read(self._ready_read, 4096):
+            self.ready_workers.add(index)
+        if not self.is_ready and len(self.ready_workers) == self.worker_count:
+            self.is_ready = True
+            self.readiness_notifier.notify_ready()
+
+    def _stop_workers(self):
+        for pid in list(self.workers):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        for pid in list(self.workers):
+            try:
+                os.waitpid(pid, 0)
+            except ChildProcessError:
+                pass
+        self.workers.clear()
+
+    def _handle_termination(self, signum, frame):
+        sys.exit(0)
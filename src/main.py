@@ -1,91 +1,173 @@
-import atexit
 import json
 import logging
+import signal
 import socket
+import sys
 from concurrent.futures import ThreadPoolExecutor
-
-from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from typing import Any
 
 from Dependencies.Constants import *
+from Dependencies.RequestTracer import request_tracer
 from Dependencies.VerbDictionary import Verbs
+from Services.AdmissionController import AdmissionController, UserConcurrencyLimiter, KeyedRateLimiter
+from Services.ConnectionLifecycleManager import ConnectionLifecycleManager, ConnectionTerminated
+from Services.EphemeralKeyPool import EphemeralKeyPool
+from Services.MasterKeyring import MasterKeyring
+from Services.PasswordHasher import PasswordHasher, PasswordHasherBusy
 from Services.SecureCommunicationManager import SecureCommunicationManager
 from Services.ServerFileService import FileService, Items
+from Services.StartupMonitor import StartupTimer, ReadinessNotifier
+from Services.StorageScrubberService import StorageScrubberService
 from Services.TokenService import TokenService
+from Services.WorkerSupervisor import WorkerSupervisor
 from Services.UsersService import UsersService
 
 
 class ServerClass:
-    def __init__(self):
+    def __init__(self, keyring=None, reuse_port=False, on_ready=None):
+        self.startup_timer = StartupTimer()
+        self.on_ready = on_ready  # called once the socket is listening
         self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        if reuse_port:
+            self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        elif os.name != "nt":
+            # so a restart can bind while the previous process's connections sit in TIME_WAIT (on Windows this would allow two servers on one port)
+            self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.is_server_running = True
+        self.password_hasher = PasswordHasher()
+        signal.signal(signal.SIGTERM, self._handle_termination)
 
-        self.user_service = UsersService()
-        self.file_service = FileService(self.user_service)
-
-        self.token_service = TokenService()
-        self.encryption_token_master_key = AESGCM.generate_key(bit_length=256)
-        logging.debug(f"Generated token master key: {self.encryption_token_master_key}")
-
-        self.host_addr = host_addr
         try:
-            self.server.bind(self.host_addr)
-        except OSError as exception:
-            logging.error(f"\n\n\nError starting server: {exception}")
+            with self.startup_timer.phase("services"):
+                self.password_hasher.warm_up()
+                self.user_service = UsersService(self.password_hasher)
+                self.user_login_limiter = KeyedRateLimiter(login_attempts_per_minute_per_user, login_burst_per_user)
+                self.ip_auth_limiter = KeyedRateLimiter(auth_attempts_per_minute_per_ip, auth_burst_per_ip)
+                self.file_service = FileService(self.user_service)
+
+            with self.startup_timer.phase("keys"):
+                self.token_service = TokenService()
+                self.key_pool = EphemeralKeyPool()
+                self.keyring = keyring if keyring is not None else MasterKeyring()
+
+            with self.startup_timer.phase("bind"):
+                self.host_addr = host_addr
+                try:
+                    self.server.bind(self.host_addr)
+                except OSError as exception:
+                    logging.error(f"\n\n\nError starting server: {exception}")
+                    raise
+
+            with self.startup_timer.phase("pools"):
+                worker_count = 2*os.cpu_count()
+                self.pool = ThreadPoolExecutor(worker_count)
+                self.admission_controller = AdmissionController(worker_count)
+                self.user_concurrency_limiter = UserConcurrencyLimiter()
+                self.connection_lifecycle_manager = ConnectionLifecycleManager()
+                self.storage_scrubber = StorageScrubberService(self.file_service.files_database_dao, self.file_service.files_disk_dao)
+                if scrubber_enabled:
+                    self.storage_scrubber.start()
+
+            self._server_listen()
+        finally:
             self.server_close()
             logging.info("Server Closed.")
-            return
-
-        self.pool = ThreadPoolExecutor(2*os.cpu_count())
-
-        self._server_listen()
 
     def server_close(self):
         self.server.close()
         self.is_server_running = False
+        # the scrypt pool's processes (and the forkserver behind them) would otherwise outlive this process
+        self.password_hasher.close()
+
+    def _handle_termination(self, signum, frame):
+        # SIGTERM: leave the accept loop like Ctrl-C does, so the cleanup above runs
+        sys.exit(0)
 
     def _server_listen(self):
         try:
             self.server.listen(100)
             logging.info(f"Server listening On: {self.host_addr}")
+            self.startup_timer.finish()
+            if self.on_ready:
+                self.on_ready()
             while self.is_server_running:
                 client, client_addr = self.server.accept()
                 logging.info(f"\n\n\n\nClient Connected: {client_addr}")
-                self.pool.submit(self._begin_client_communication, client, client_addr)
+                if self.admission_controller.try_admit():
+                    self.pool.submit(self._begin_client_communication, client, client_addr)
+                else:
+                    self._reject_client(client, client_addr)
         except KeyboardInterrupt:
-            self.server_close()
+            pass
+
+    def _reject_client(self, client, client_addr):
+        # No session key exists yet, so the busy frame goes out unencrypted: busy_flag, empty token and nonce, retry-after seconds
+        logging.warning(f"Server overloaded. Rejecting {client_addr}.")
+        try:
+            client.settimeout(0.1)
+            client.sendall(busy_flag + encryption_separator + encryption_separator + encryption_separator
+                           + str(overload_retry_after_seconds).encode() + end_flag)
+        except OSError as exception:
+            logging.debug(f"Could not send busy frame to {client_addr}: {exception}")
         finally:
-            self.server_close()
-            logging.info("Server Closed.")
+            client.close()
 
     def _begin_client_communication(self, client, client_addr):
-        logging.info(f"Receiving Message From: {client_addr}")
-        secure_communication_manager = SecureCommunicationManager(client, self.token_service, self.encryption_token_master_key)
-        message = secure_communication_manager.receive_data().decode()
-        logging.info(f"Message Received: {message}. Parsing Message...")
-        self._parse_message(message, secure_communication_manager)
+        request_tracer.start_request(client_addr)
+        outcome = "completed"
+        try:
+            logging.info(f"Receiving Message From: {client_addr}")
+            connection = self.connection_lifecycle_manager.track(client)
+            secure_communication_manager = SecureCommunicationManager(connection, self.token_service, self.keyring, self.key_pool)
+            message = secure_communication_manager.receive_data().decode()
+            connection.end_request_deadline()
+            logging.info(f"Message Received: {message}. Parsing Message...")
+            self._parse_message(message, secure_communication_manager, client_addr)
+        except ConnectionTerminated as exception:
+            outcome = exception.reason
+            logging.info(f"Dropping {client_addr}: {exception}")
+        except Exception:
+            outcome = "error"
+            logging.exception(f"Error handling request from {client_addr}")
+        finally:
+            self.connection_lifecycle_manager.record_outcome(outcome)
+            request_tracer.finish_request()
+            client.close()
+            self.admission_controller.release()
 
-    def _parse_message(self, message, secure_communication_manager: SecureCommunicationManager):
+    def _parse_message(self, message, secure_communication_manager: SecureCommunicationManager, client_addr):
         client_token, data, verb = self._get_data_from_request(message)
+        request_tracer.set_verb(verb)
 
         logging.debug(f"Verb: {verb}, Token: {client_token},\n Data: {data[0:len(data)]}")
 
         client_token, is_token_valid, username = self._handle_token(client_token)
 
-        needs_file_contents, response, response_data = self._handle_action(client_token, data, is_token_valid,
-                                                                           username, verb)
+        if is_token_valid and not self.user_concurrency_limiter.try_acquire(username):
+            response = self._write_message("ERROR", client_token, "TOO_MANY_REQUESTS")
+            self._handle_response(client_token, data, False, response, str(overload_retry_after_seconds),
+                                  secure_communication_manager, username, verb)
+            return
 
-        self._handle_response(client_token, data, needs_file_contents, response, response_data,
-                              secure_communication_manager, username)
+        try:
+            needs_file_contents, response, response_data = self._handle_action(client_token, data, is_token_valid,
+                                                                               username, verb, client_addr)
+
+            self._handle_response(client_token, data, needs_file_contents, response, response_data,
+                                  secure_communication_manager, username, verb)
+        finally:
+            if is_token_valid:
+                self.user_concurrency_limiter.release(username)
 
     def _handle_response(self, client_token, data, needs_file_contents, response, response_data,
-                         secure_communication_manager: SecureCommunicationManager, username):
+                         secure_communication_manager: SecureCommunicationManager, username, verb):
         self._log_response_details(response, response_data)
 
         response = response.encode()
 
         self._send_initial_response(response, response_data, secure_communication_manager)
 
-        self._receive_data_if_needed(client_token, data, needs_file_contents, secure_communication_manager, username)
+        self._receive_data_if_needed(client_token, data, needs_file_contents, secure_communication_manager, username, verb)
 
     def _get_data_from_request(self, message) -> Any:
         message_parts = message.split(separator)
@@ -109,8 +191,10 @@ class ServerClass:
         return client_token, is_token_valid, username
 
     def _receive_data_if_needed(self, client_token, data, needs_file_contents,
-                                secure_communication_manager: SecureCommunicationManager, username):
-        if needs_file_contents:
+                                secure_communication_manager: SecureCommunicationManager, username, verb):
+        if needs_file_contents and verb == Verbs.BULK_UPLOAD.value:
+            self._receive_bulk_upload(client_token, secure_communication_manager, username)
+        elif needs_file_contents:
             logging.debug("Waiting for Data")
             data_received = secure_communication_manager.receive_data()
             if self.file_service.create_file(username, data[0], data[1], data_received):
@@ -120,34 +204,54 @@ class ServerClass:
                 secure_communication_manager.respond_to_client(
                     self._write_message("ERROR", client_token, "FILE_NOT_CREATED").encode())
 
+    def _receive_bulk_upload(self, client_token, secure_communication_manager: SecureCommunicationManager, username):
+        logging.debug("Waiting for bulk upload frames")
+        try:
+            results = self.file_service.bulk_upload(username, self._receive_frames(secure_communication_manager))
+        except ValueError as exception:
+            logging.error(f"Bulk upload aborted: {exception}")
+            secure_communication_manager.respond_to_client(
+                self._write_message("ERROR", client_token, "INVALID_BULK_UPLOAD").encode())
+            return
+        secure_communication_manager.respond_to_client(self._write_message("SUCCESS", client_token, "FILES_CREATED").encode(),
+                                                       string_data_flag, json.dumps([result.__dict__ for result in results]).encode())
+
+    def _receive_frames(self, secure_communication_manager: SecureCommunicationManager):
+        # an empty frame ends the stream
+        secure_communication_manager.connection.start_stream()
+        while frame := secure_communication_manager.receive_data():
+            if not isinstance(frame, bytes):
+                raise ValueError("Invalid frame in bulk upload stream.")
+            yield frame
+
     def _send_initial_response(self, response, response_data, secure_communication_manager: SecureCommunicationManager):
         if len(response_data) > 0:
             logging.debug("Adding data to response")
+            # passed as separate parts so file contents are encrypted in place rather than copied into the message
             if isinstance(response_data, str):
-                response += string_data_flag + response_data.encode()
+                secure_communication_manager.respond_to_client(response, string_data_flag, response_data.encode())
             else:
-                response += byte_data_flag + response_data
-            logging.debug(f"Message with data: {response}")
-
-        secure_communication_manager.respond_to_client(response)
+                secure_communication_manager.respond_to_client(response, byte_data_flag, response_data)
+        else:
+            secure_communication_manager.respond_to_client(response)
 
     def _log_response_details(self, response, response_data):
         logging.debug(f"Response: {response}")
-        logging.debug(f"Response Data: {response_data}")
+        logging.debug(f"Response Data: {response_data[:100]}")
         logging.debug(f"Response Data Length: {len(response_data)}, type: {type(response_data)}")
 
     def _handle_action(self, client_token, data, is_token_valid, username,
-                       verb) -> Any:
+                       verb, client_addr) -> Any:
         response = ""
         response_data = ""
         needs_file_contents = False
 
         match verb:
             case Verbs.SIGN_UP.value:
-                response = self._sign_up(client_token, data, response)
+                response, response_data = self._sign_up(client_token, data, client_addr, response, response_data)
 
             case Verbs.LOG_IN.value:
-                response = self._login(client_token, data, response)
+                response, response_data = self._login(client_token, data, client_addr, response, response_data)
 
             case Verbs.DOWNLOAD_FILE.value:
                 response, response_data = self._download_file(client_token, data, is_token_valid, response,
@@ -161,6 +265,10 @@ class ServerClass:
                 needs_file_contents, response = self._create_file(client_token, data, is_token_valid,
                                                                   needs_file_contents, response, username)
 
+            case Verbs.BULK_UPLOAD.value:
+                needs_file_contents, response = self._bulk_upload(client_token, is_token_valid, needs_file_contents,
+                                                                  response)
+
             case Verbs.DELETE_FILE.value:
                 response = self._delete_file(client_token, data, is_token_valid, response, username)
 
@@ -182,11 +290,106 @@ class ServerClass:
             case Verbs.MOVE_DIR.value:
                 response = self._move_dir(client_token, data, is_token_valid, response, username)
 
+            case Verbs.COPY_FILE.value:
+                response = self._copy_file(client_token, data, is_token_valid, response, username)
+
+            case Verbs.COPY_DIR.value:
+                response = self._copy_dir(client_token, data, is_token_valid, response, username)
+
+            case Verbs.SEARCH.value:
+                response, response_data = self._search(client_token, data, is_token_valid, response, response_data,
+                                                       username)
+
+            case Verbs.ADMIN_GET_STATS.value:
+                response, response_data = self._admin_get_stats(client_token, client_addr, response, response_data)
+
+            case Verbs.ADMIN_SET_PROFILING.value:
+                response = self._admin_set_profiling(client_token, data, client_addr, response)
+
             case _:
                 logging.debug("Invalid Verb")
                 response = self._write_message("ERROR", client_token, "INVALID_VERB")
         return needs_file_contents, response, response_data
 
+    def _admin_get_stats(self, client_token, client_addr, response, response_data) -> Any:
+        logging.debug("verb = ADMIN_GET_STATS")
+        if client_addr[0] in admin_addresses:
+            response = self._write_message("SUCCESS", client_token, "SENDING_DATA")
+            response_data = json.dumps(self._get_server_stats())
+        else:
+            response = self._write_message("ERROR", client_token, "FORBIDDEN")
+        return response, response_data
+
+    def _admin_set_profiling(self, client_token, data, client_addr, response) -> Any:
+        logging.debug("verb = ADMIN_SET_PROFILING")
+        if client_addr[0] in admin_addresses:
+            try:
+                request_tracer.set_profile_sample_rate(data[0])
+                response = self._write_message("SUCCESS", client_token)
+            except (IndexError, ValueError):
+                response = self._write_message("ERROR", client_token, "INVALID_SAMPLE_RATE")
+        else:
+            response = self._write_message("ERROR", client_token, "FORBIDDEN")
+        return response
+
+    def _get_server_stats(self):
+        return {
+            "pid": os.getpid(),
+            "tracing": request_tracer.get_stats(),
+            "ephemeral_key_pool": self.key_pool.get_stats(),
+            "admission": self.admission_controller.get_stats(),
+            "user_concurrency": self.user_concurrency_limiter.get_stats(),
+            "passwords": self.password_hasher.get_stats(),
+            "login_rate_limits": {"per_user": self.user_login_limiter.get_stats(), "per_ip": self.ip_auth_limiter.get_stats()},
+            "connections": self.connection_lifecycle_manager.get_stats(),
+            "fsync": self.file_service.files_disk_dao.fsync_batcher.get_stats(),
+            "scrubber": self.storage_scrubber.get_stats(),
+            "file_cache": self.file_service.file_contents_cache.get_stats(),
+            "master_keys": self.keyring.get_stats(),
+            "startup": self.startup_timer.get_stats(),
+            "blob_copies": self.file_service.files_disk_dao.get_copy_stats(),
+        }
+
+    def _search(self, client_token, data, is_token_valid, response, response_data, username) -> Any:
+        logging.debug("verb = SEARCH")
+        if is_token_valid:
+            # trailing parameters may be left out
+            query, match, item_type, min_size, max_size, cursor, page_size = (data + [""] * 7)[:7]
+            try:
+                results, next_cursor = self.file_service.search(
+                    username, query, match or "substring", item_type or "any",
+                    int(min_size) if min_size else None, int(max_size) if max_size else None,
+                    int(cursor) if cursor else 0, int(page_size) if page_size else search_default_page_size)
+                response = self._write_message("SUCCESS", client_token, "SENDING_DATA")
+                response_data = json.dumps({"results": [result.__dict__ for result in results], "next_cursor": next_cursor})
+            except ValueError:
+                response = self._write_message("ERROR", client_token, "INVALID_SEARCH")
+        else:
+            response = self._write_message("ERROR", client_token, "INVALID_TOKEN")
+        return response, response_data
+
+    def _copy_dir(self, client_token, data, is_token_valid, response, username) -> Any:
+        logging.debug("verb = COPY_DIR")
+        if is_token_valid:
+            if self.file_service.copy_dir(username, data[0], data[1], data[2], data[3]):
+                response = self._write_message("SUCCESS", client_token)
+            else:
+                response = self._write_message("ERROR", client_token, "DIR_NOT_FOUND_OR_ALREADY_EXISTS")
+        else:
+            response = self._write_message("ERROR", client_token, "INVALID_TOKEN")
+        return response
+
+    def _copy_file(self, client_token, data, is_token_valid, response, username) -> Any:
+        logging.debug("verb = COPY_FILE")
+        if is_token_valid:
+            if self.file_service.copy_file(username, data[0], data[1], data[2], data[3]):
+                response = self._write_message("SUCCESS", client_token)
+            else:
+                response = self._write_message("ERROR", client_token, "FILE_NOT_FOUND_OR_ALREADY_EXISTS")
+        else:
+            response = self._write_message("ERROR", client_token, "INVALID_TOKEN")
+        return response
+
     def _move_dir(self, client_token, data, is_token_valid, response, username) -> Any:
         if is_token_valid:
             if self.file_service.move_dir(username, data[0], data[1], data[2]):
@@ -271,6 +474,15 @@ class ServerClass:
             response = self._write_message("ERROR", client_token, "INVALID_TOKEN")
         return needs_file_contents, response
 
+    def _bulk_upload(self, client_token, is_token_valid, needs_file_contents, response) -> Any:
+        logging.debug("verb = BULK_UPLOAD")
+        if is_token_valid:
+            response = self._write_message("SUCCESS", client_token, "READY_FOR_DATA")
+            needs_file_contents = True
+        else:
+            response = self._write_message("ERROR", client_token, "INVALID_TOKEN")
+        return needs_file_contents, response
+
     def _get_items_list(self, client_token, data, is_token_valid, response, response_data, username) -> Any:
         logging.debug("verb = GET_FILES_LIST")
         if is_token_valid:
@@ -290,31 +502,52 @@ class ServerClass:
     def _download_file(self, client_token, data, is_token_valid, response, response_data, username) -> Any:
         logging.debug("verb = DOWNLOAD_FILE")
         if is_token_valid:
-            response_data = self.file_service.get_file_contents(username, data[0], data[1])
-            response = self._write_message("SUCCESS", client_token, "SENDING_DATA")
+            try:
+                response_data = self.file_service.get_file_contents(username, data[0], data[1])
+                response = self._write_message("SUCCESS", client_token, "SENDING_DATA")
+            except FileNotFoundError:
+                response = self._write_message("ERROR", client_token, "FILE_NOT_FOUND")
         else:
             response = self._write_message("ERROR", client_token, "INVALID_TOKEN")
         return response, response_data
 
-    def _login(self, client_token, data, response) -> Any:
+    def _login(self, client_token, data, client_addr, response, response_data) -> Any:
         logging.debug("verb = LOG_IN")
-        if self.user_service.login(data[0], data[1]):
-            response = self._write_message("SUCCESS", self.token_service.create_login_token(username=data[0]))
-        else:
-            response = self._write_message("ERROR", client_token, "INVALID_CREDENTIALS")
-        return response
+        retry_after = self.ip_auth_limiter.try_acquire(client_addr[0]) or self.user_login_limiter.try_acquire(data[0])
+        if retry_after:
+            response = self._write_message("ERROR", client_token, "TOO_MANY_REQUESTS")
+            response_data = str(retry_after)
+            return response, response_data
+        try:
+            if self.user_service.login(data[0], data[1]):
+                response = self._write_message("SUCCESS", self.token_service.create_login_token(username=data[0]))
+            else:
+                response = self._write_message("ERROR", client_token, "INVALID_CREDENTIALS")
+        except PasswordHasherBusy:
+            response = self._write_message("ERROR", client_token, "TOO_MANY_REQUESTS")
+            response_data = str(overload_retry_after_seconds)
+        return response, response_data
 
-    def _sign_up(self, client_token, data, response) -> Any:
+    def _sign_up(self, client_token, data, client_addr, response, response_data) -> Any:
         logging.debug("verb = SIGN_UP")
-        if self.user_service.create_user(data[0], data[1]):
-            logging.debug(f"Created User: {data[0]}, with password hash: {data[1]}")
-            self.file_service.create_dir(data[0], None, "/")
-            logging.debug(f"Created root directory for user: {data[0]}")
-            response = self._write_message("SUCCESS", self.token_service.create_login_token(username=data[0]))
-        else:
-            logging.debug(f"User {data[0]} already exists.")
-            response = self._write_message("ERROR", client_token, "USER_EXISTS")
-        return response
+        retry_after = self.ip_auth_limiter.try_acquire(client_addr[0])
+        if retry_after:
+            response = self._write_message("ERROR", client_token, "TOO_MANY_REQUESTS")
+            response_data = str(retry_after)
+            return response, response_data
+        try:
+            if self.user_service.create_user(data[0], data[1]):
+                logging.debug(f"Created User: {data[0]}")
+                self.file_service.create_dir(data[0], None, "/")
+                logging.debug(f"Created root directory for user: {data[0]}")
+                response = self._write_message("SUCCESS", self.token_service.create_login_token(username=data[0]))
+            else:
+                logging.debug(f"User {data[0]} already exists.")
+                response = self._write_message("ERROR", client_token, "USER_EXISTS")
+        except PasswordHasherBusy:
+            response = self._write_message("ERROR", client_token, "TOO_MANY_REQUESTS")
+            response_data = str(overload_retry_after_seconds)
+        return response, response_data
 
     def _write_message(self, success, token, status_code=None):
         logging.debug(f"Writing Message: Success?: {success}")
@@ -325,8 +558,17 @@ class ServerClass:
         return message
 
 if __name__ == "__main__":
-    logging.basicConfig(level=logging.DEBUG, format='%(asctime)s | %(threadName)-12s | %(levelname)-5s | %(message)s')
-    a = ServerClass()
-    atexit.register(ServerClass.server_close, a)
-
-
+    logging.basicConfig(level=log_level, format='%(asctime)s | %(process)-6d | %(threadName)-12s | %(levelname)-5s | %(message)s')
+    if server_worker_processes > 1 and hasattr(socket, "SO_REUSEPORT"):
+        WorkerSupervisor(lambda keyring, on_ready: ServerClass(keyring, reuse_port=True, on_ready=on_ready)).run()
+    else:
+        if server_worker_processes > 1:
+            logging.warning("SO_REUSEPORT is not available on this platform. Running a single server process.")
+        readiness_notifier = ReadinessNotifier()
+        try:
+            # returns (or raises SystemExit from its SIGTERM handler) once the server is closed
+            ServerClass(on_ready=readiness_notifier.notify_ready)
+        except OSError:
+            sys.exit(1)  # already logged
+        finally:
+            readiness_notifier.notify_stopping()